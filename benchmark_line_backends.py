@@ -0,0 +1,83 @@
+# ファイル名: benchmark_line_backends.py
+# 役割: 録画セッションのフレームで、操舵の線分検出バックエンドを比較する
+#       - 1フレームあたりの処理時間 (線分検出 + 消失点計算)
+#       - vp_x が HoughLinesP (従来方式) とどれだけ一致するか
+# 使い方: python3 benchmark_line_backends.py <録画ディレクトリ> [<録画ディレクトリ> ...]
+
+import sys
+import time
+import numpy as np
+
+from frame_exchange import FramePyramid
+from frame_source import RecordedSource
+from vision_utils import SteeringProcessor, available_line_backends, make_line_backend, estimate_vanishing_point
+
+# --- function1120.vision_processing_thread と同じパラメータ ---
+RESIZE_WIDTH = 240
+MIN_NOISE_AREA = 45
+CANNY_THRESHOLD1 = 100
+CANNY_THRESHOLD2 = 150
+HOUGH_THRESHOLD = 35
+HOUGH_MIN_LINE_LENGTH = 35
+HOUGH_MAX_LINE_GAP = 10
+CLIP_LIMIT = 15.0
+TILE_GRID_SIZE = (4, 4)
+
+REFERENCE_BACKEND = 'hough'
+AGREEMENT_PX = 5   # 基準との vp_x の差がこれ以内なら一致とみなす [px]
+
+
+def run_benchmark(session_paths):
+    """各バックエンドの {名前: (処理時間[ms]のリスト, vp_x のリスト)} を返す"""
+    backends = {}
+    for name in available_line_backends():
+        processor = SteeringProcessor(CLIP_LIMIT, TILE_GRID_SIZE, CANNY_THRESHOLD1, CANNY_THRESHOLD2, MIN_NOISE_AREA)
+        backends[name] = make_line_backend(name, processor, HOUGH_THRESHOLD, HOUGH_MIN_LINE_LENGTH, HOUGH_MAX_LINE_GAP)
+    results = {name: ([], []) for name in backends}
+
+    for path in session_paths:
+        source = RecordedSource(path, realtime=False)
+        source.start()
+        while True:
+            frame = source.read()
+            if frame is None:
+                break
+            gray = FramePyramid(frame.color).get(f'gray@{RESIZE_WIDTH}')
+            height, width = gray.shape[:2]
+
+            for name, backend in backends.items():
+                start = time.perf_counter()
+                lines = backend.detect(gray)
+                vp_x = estimate_vanishing_point(lines, width, height)
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                results[name][0].append(elapsed_ms)
+                results[name][1].append(vp_x)
+        source.stop()
+    return results
+
+
+def print_report(results):
+    reference_vps = results[REFERENCE_BACKEND][1]
+    num_frames = len(reference_vps)
+    print(f"\nフレーム数: {num_frames} (基準: {REFERENCE_BACKEND}, 一致: ±{AGREEMENT_PX}px)")
+    print(f"{'方式':<6} {'中央値[ms]':>10} {'p95[ms]':>8} {'検出率':>7} {'一致率':>7} {'平均差[px]':>10}")
+
+    for name, (times, vps) in results.items():
+        detected = [vp is not None for vp in vps]
+        # 両方で消失点が出たフレームだけで一致度を見る
+        diffs = [abs(vp - ref) for vp, ref in zip(vps, reference_vps) if vp is not None and ref is not None]
+        agreement = np.mean([d <= AGREEMENT_PX for d in diffs]) if diffs else float('nan')
+        mean_diff = np.mean(diffs) if diffs else float('nan')
+        print(f"{name:<6} {np.median(times):10.2f} {np.percentile(times, 95):8.2f} "
+              f"{np.mean(detected):7.1%} {agreement:7.1%} {mean_diff:10.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("使い方: python3 benchmark_line_backends.py <録画ディレクトリ> [...]")
+        sys.exit(1)
+    results = run_benchmark(sys.argv[1:])
+    if not results[REFERENCE_BACKEND][0]:
+        print("エラー: 録画にフレームがありません。")
+        sys.exit(1)
+    print_report(results)
@@ -0,0 +1,379 @@
+#
+# ファイル名: frame_exchange.py
+# 役割: カメラと各処理スレッド/プロセスの間でフレームを受け渡すモジュール
+#
+
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+
+class FramePyramid:
+    """
+    1フレーム分の前処理結果のキャッシュ。
+    'gray' (元解像度のグレースケール) や 'gray@240' (幅240pxに縮小) のような
+    名前で要求され、最初の要求時に1回だけ計算して全ての読み出し側で共有する。
+    縮小は元解像度のグレースケールから行うので、cvtColor は1フレーム1回で済む。
+    """
+    def __init__(self, color):
+        self._color = color
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def get(self, name):
+        image = self._cache.get(name)
+        if image is None:
+            with self._lock:
+                image = self._cache.get(name)
+                if image is None:
+                    image = self._compute(name)
+                    self._cache[name] = image
+        return image
+
+    def _compute(self, name):
+        kind, _, width = name.partition('@')
+        if kind not in ('gray', 'bgr'):
+            raise ValueError(f"unknown preprocessing name: {name}")
+
+        if not width:
+            if kind == 'bgr':
+                return self._color
+            return cv2.cvtColor(self._color, cv2.COLOR_BGR2GRAY)
+
+        # 元のスレッドと同じ計算で高さを決める (640x480 -> 240x180, 360x270)
+        base = self.get(kind)
+        orig_height, orig_width = base.shape[:2]
+        resize_width = int(width)
+        resize_height = int(resize_width * (orig_height / orig_width))
+        return cv2.resize(base, (resize_width, resize_height), interpolation=cv2.INTER_AREA)
+
+
+class FramePacket:
+    """
+    1回の取得で得られたRGB+Depthのペア。
+    seq はフレーム交換器が振る通し番号 (1から始まる)。
+    timestamp / frame_number はカメラのハードウェアタイムスタンプ[ms]とフレーム番号。
+    capture_time はカメラの取得時刻 (time.time() 基準) で、遅延計測の起点に使う。
+    ソースが取得時刻を出せない (タイムスタンプがシステム時刻基準でない) 場合は公開時刻と同じ値。
+    publish_time はフレーム交換器へ公開した時刻。
+    view('gray@240') で前処理済み画像を取得できる (同じフレームなら計算は共有)。
+    """
+    __slots__ = ('seq', 'color', 'depth', 'timestamp', 'frame_number', 'capture_time', 'publish_time', 'pyramid')
+
+    def __init__(self, seq, color, depth, timestamp=0.0, frame_number=0, capture_time=0.0, publish_time=None,
+                 pyramid=None):
+        self.seq = seq
+        self.color = color
+        self.depth = depth
+        self.timestamp = timestamp
+        self.frame_number = frame_number
+        self.capture_time = capture_time
+        self.publish_time = publish_time if publish_time is not None else capture_time
+        self.pyramid = pyramid if pyramid is not None else FramePyramid(color)
+
+    def view(self, name):
+        return self.pyramid.get(name)
+
+
+class FrameExchange:
+    """
+    RGB+Depthフレーム受け渡し用の3スロットのリングバッファ。
+
+    書き込み側(カメラスレッド)は公開中でないスロットへ書き込み、
+    書き終えたら (通し番号, スロット番号) を1回の代入で公開する。
+    読み出し側はロックを取らずに最新の完全なペアを参照できる。
+    パケットの color / depth はスロットのバッファそのもの (読み出し側ごとのコピーではない) で、
+    その後2フレーム公開されると上書きされる (20fpsで約100msの読み出し窓)。
+    読み終えた後に is_intact(packet) を確認し、False ならそのフレームの結果は捨てる。
+    (warm で公開前に計算した前処理 (例: 'gray') は別の配列なので上書きされない)
+    新しいフレームを待つ側は wait_for_frame() で眠り、公開時に起こされる。
+    """
+    NUM_SLOTS = 3
+
+    def __init__(self, warm=()):
+        self._color_slots = [None] * self.NUM_SLOTS
+        self._depth_slots = [None] * self.NUM_SLOTS
+        self._pyramids = [None] * self.NUM_SLOTS
+        self._meta = [(0.0, 0, 0.0, 0.0)] * self.NUM_SLOTS  # (timestamp, frame_number, capture_time, publish_time)
+        # 公開前にカメラスレッド側で計算しておく前処理 (例: ('gray',))
+        self._warm = tuple(warm)
+        # (通し番号, スロット番号) ※タプルの差し替えはGIL下で原子的
+        self._published = (0, -1)
+        # 距離計算に必要なスケール (カメラ起動時に設定)
+        self.depth_scale = 0.001
+        # 位置合わせ前の深度画像上の壁ROI {'left': (y1, y2, x1, x2), ...}
+        # None の場合、深度画像はRGBに位置合わせ済み
+        self.depth_rois = None
+        # 深度画像の列 x -> RGB画像の横位置 (-1.0〜1.0) の一次式 (scale, offset)
+        # None の場合、深度画像はRGBに位置合わせ済み
+        self.depth_column_map = None
+        # 新フレーム到着の通知用 (待機中の読み出し側がいる時だけ使う)
+        self._cond = threading.Condition(threading.Lock())
+        self._waiters = 0
+
+    @staticmethod
+    def _store(slots, slot, image):
+        # 初回・解像度変更時のみ確保し、以降は同じ領域へコピーする
+        buf = slots[slot]
+        if buf is None or buf.shape != image.shape or buf.dtype != image.dtype:
+            buf = np.empty_like(image)
+            slots[slot] = buf
+        np.copyto(buf, image)
+
+    def publish(self, color_image, depth_image, timestamp=0.0, frame_number=0, capture_time=None):
+        """
+        新しいフレームを書き込んで公開し、その通し番号を返す (書き込み側は1スレッドのみ)。
+        capture_time (取得時刻、time.time() 基準) を省略すると公開時刻を使う。
+        """
+        publish_time = time.time()
+        if capture_time is None:
+            capture_time = publish_time
+        seq, latest_slot = self._published
+        slot = (latest_slot + 1) % self.NUM_SLOTS
+
+        self._store(self._color_slots, slot, color_image)
+        if depth_image is not None:
+            self._store(self._depth_slots, slot, depth_image)
+        else:
+            self._depth_slots[slot] = None
+
+        pyramid = FramePyramid(self._color_slots[slot])
+        for name in self._warm:
+            pyramid.get(name)
+        self._pyramids[slot] = pyramid
+        self._meta[slot] = (timestamp, frame_number, capture_time, publish_time)
+
+        self._published = (seq + 1, slot)
+        if self._waiters:
+            with self._cond:
+                self._cond.notify_all()
+        return seq + 1
+
+    @property
+    def seq(self):
+        """最後に公開されたフレームの通し番号 (未公開なら0)"""
+        return self._published[0]
+
+    def latest(self):
+        """最新の完全なフレームを返す (まだ無ければ None)"""
+        seq, slot = self._published
+        if slot < 0:
+            return None
+        timestamp, frame_number, capture_time, publish_time = self._meta[slot]
+        return FramePacket(seq, self._color_slots[slot], self._depth_slots[slot],
+                           timestamp, frame_number, capture_time, publish_time, self._pyramids[slot])
+
+    def wait_for_frame(self, last_seq, timeout=None):
+        """
+        通し番号が last_seq より新しいフレームが公開されるまで待って返す。
+        timeout 秒以内に来なければ None (停止フラグの確認に使う)。
+        """
+        if self._published[0] > last_seq:
+            return self.latest()
+        with self._cond:
+            self._waiters += 1
+            try:
+                self._cond.wait_for(lambda: self._published[0] > last_seq, timeout)
+            finally:
+                self._waiters -= 1
+        if self._published[0] > last_seq:
+            return self.latest()
+        return None
+
+    def is_intact(self, packet):
+        """取得済みのパケットのスロットがまだ上書きされていないかを返す (読み終えた後に確認する)"""
+        return self._published[0] - packet.seq < self.NUM_SLOTS - 1
+
+
+class SharedFrameRing:
+    """
+    プロセス間でRGB+Depthフレームを受け渡すリングバッファ。
+    multiprocessing.shared_memory 上にスロットを並べ、各スロットは
+    numpy配列のビューとしてコピーなしで参照できる。
+
+    FrameExchange と同じ使い方 (publish / latest / wait_for_frame) ができるので、
+    スレッド関数をそのままワーカープロセスで動かせる。
+    書き込みは seq % NUM_SLOTS 番のスロットへ行い、
+    各スロットの通し番号(書き込み中は -1)で読み出し側が上書きを検出する
+    (パケットは共有メモリ上のビューなので、読み終えた後に is_intact(packet) を確認する)。
+    """
+    NUM_SLOTS = 4
+
+    # ヘッダー (int64): [公開済み通し番号, スロット毎の通し番号 x NUM_SLOTS,
+    #                   壁ROI (左 y1,y2,x1,x2, 右 y1,y2,x1,x2),
+    #                   スロット毎のフレーム番号 x NUM_SLOTS, スロット毎の深度の有無 (1/0) x NUM_SLOTS]
+    #        (float64): [depth_scale, スロット毎のタイムスタンプ x NUM_SLOTS,
+    #                   スロット毎の取得時刻 x NUM_SLOTS, スロット毎の公開時刻 x NUM_SLOTS,
+    #                   深度の列の対応 (scale, offset)]
+    _ROI_SIDES = ('left', 'right')
+    _ROI_OFFSET = 1 + NUM_SLOTS
+    _FRAME_NUMBER_OFFSET = _ROI_OFFSET + 4 * len(_ROI_SIDES)
+    _HAS_DEPTH_OFFSET = _FRAME_NUMBER_OFFSET + NUM_SLOTS
+    _HEADER_INTS = _HAS_DEPTH_OFFSET + NUM_SLOTS
+    _CAPTURE_TIME_OFFSET = 1 + NUM_SLOTS
+    _PUBLISH_TIME_OFFSET = _CAPTURE_TIME_OFFSET + NUM_SLOTS
+    _COLUMN_MAP_OFFSET = _PUBLISH_TIME_OFFSET + NUM_SLOTS
+    _HEADER_FLOATS = _COLUMN_MAP_OFFSET + 2
+    _HEADER_BYTES = (_HEADER_INTS + _HEADER_FLOATS) * 8
+
+    def __init__(self, color_shape, depth_shape, name=None, create=True, cond=None):
+        color_bytes = int(np.prod(color_shape))
+        depth_bytes = int(np.prod(depth_shape)) * 2
+        size = self._HEADER_BYTES + (color_bytes + depth_bytes) * self.NUM_SLOTS
+
+        self.color_shape = tuple(color_shape)
+        self.depth_shape = tuple(depth_shape)
+        self._creator = create
+        self._shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        # プロセス間の新フレーム通知用
+        self._cond = cond if cond is not None else multiprocessing.Condition()
+        # 前処理キャッシュはプロセス毎に持つ: スロット毎に (通し番号, FramePyramid)
+        self._pyramids = [(0, None)] * self.NUM_SLOTS
+        self._map_views()
+
+        if create:
+            self._header[:] = -1
+            self._header[0] = 0
+            self._floats[:] = 0.0
+            self._floats[0] = 0.001
+            self._floats[self._COLUMN_MAP_OFFSET:] = np.nan
+
+    def _map_views(self):
+        buf = self._shm.buf
+        self._header = np.ndarray((self._HEADER_INTS,), dtype=np.int64, buffer=buf)
+        self._floats = np.ndarray((self._HEADER_FLOATS,), dtype=np.float64, buffer=buf,
+                                  offset=self._HEADER_INTS * 8)
+        offset = self._HEADER_BYTES
+        self._color_slots = []
+        self._depth_slots = []
+        for _ in range(self.NUM_SLOTS):
+            color = np.ndarray(self.color_shape, dtype=np.uint8, buffer=buf, offset=offset)
+            offset += color.nbytes
+            depth = np.ndarray(self.depth_shape, dtype=np.uint16, buffer=buf, offset=offset)
+            offset += depth.nbytes
+            self._color_slots.append(color)
+            self._depth_slots.append(depth)
+
+    # spawn方式で子プロセスへ渡す時は、名前から共有メモリへ付け直す
+    def __getstate__(self):
+        return (self.color_shape, self.depth_shape, self._shm.name, self._cond)
+
+    def __setstate__(self, state):
+        color_shape, depth_shape, name, cond = state
+        self.__init__(color_shape, depth_shape, name=name, create=False, cond=cond)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def depth_scale(self):
+        return float(self._floats[0])
+
+    @depth_scale.setter
+    def depth_scale(self, value):
+        self._floats[0] = value
+
+    @property
+    def depth_rois(self):
+        rois = self._header[self._ROI_OFFSET:self._FRAME_NUMBER_OFFSET].reshape(len(self._ROI_SIDES), 4)
+        if rois[0, 0] < 0:
+            return None
+        return {side: tuple(int(v) for v in roi) for side, roi in zip(self._ROI_SIDES, rois)}
+
+    @depth_rois.setter
+    def depth_rois(self, rois):
+        header_rois = self._header[self._ROI_OFFSET:self._FRAME_NUMBER_OFFSET].reshape(len(self._ROI_SIDES), 4)
+        if rois is None:
+            header_rois[:] = -1
+            return
+        for i, side in enumerate(self._ROI_SIDES):
+            header_rois[i] = rois[side]
+
+    @property
+    def depth_column_map(self):
+        column_map = self._floats[self._COLUMN_MAP_OFFSET:self._COLUMN_MAP_OFFSET + 2]
+        if np.isnan(column_map[0]):
+            return None
+        return float(column_map[0]), float(column_map[1])
+
+    @depth_column_map.setter
+    def depth_column_map(self, column_map):
+        self._floats[self._COLUMN_MAP_OFFSET:self._COLUMN_MAP_OFFSET + 2] = np.nan if column_map is None else column_map
+
+    def publish(self, color_image, depth_image, timestamp=0.0, frame_number=0, capture_time=None):
+        """
+        新しいフレームを書き込んで公開し、その通し番号を返す (書き込み側は1プロセスのみ)。
+        capture_time (取得時刻、time.time() 基準) を省略すると公開時刻を使う。
+        """
+        publish_time = time.time()
+        if capture_time is None:
+            capture_time = publish_time
+        if color_image.shape != self.color_shape:
+            raise ValueError(f"color shape {color_image.shape} != {self.color_shape}")
+        seq = int(self._header[0]) + 1
+        slot = seq % self.NUM_SLOTS
+
+        self._header[1 + slot] = -1  # 書き込み中
+        np.copyto(self._color_slots[slot], color_image)
+        if depth_image is not None:
+            np.copyto(self._depth_slots[slot], depth_image)
+        # 深度が無いフレームはスロットに前の深度が残っているので、latest() で None を返すよう印を付ける
+        self._header[self._HAS_DEPTH_OFFSET + slot] = depth_image is not None
+        self._header[self._FRAME_NUMBER_OFFSET + slot] = frame_number
+        self._floats[1 + slot] = timestamp
+        self._floats[self._CAPTURE_TIME_OFFSET + slot] = capture_time
+        self._floats[self._PUBLISH_TIME_OFFSET + slot] = publish_time
+        self._header[1 + slot] = seq
+        self._header[0] = seq
+
+        with self._cond:
+            self._cond.notify_all()
+        return seq
+
+    @property
+    def seq(self):
+        """最後に公開されたフレームの通し番号 (未公開なら0)"""
+        return int(self._header[0])
+
+    def latest(self):
+        """最新のフレームを共有メモリ上のビューとして返す (まだ無ければ None)"""
+        seq = int(self._header[0])
+        if seq == 0:
+            return None
+        slot = seq % self.NUM_SLOTS
+        cached_seq, pyramid = self._pyramids[slot]
+        if cached_seq != seq:
+            pyramid = FramePyramid(self._color_slots[slot])
+            self._pyramids[slot] = (seq, pyramid)
+        depth = self._depth_slots[slot] if self._header[self._HAS_DEPTH_OFFSET + slot] == 1 else None
+        return FramePacket(seq, self._color_slots[slot], depth,
+                           float(self._floats[1 + slot]),
+                           int(self._header[self._FRAME_NUMBER_OFFSET + slot]),
+                           float(self._floats[self._CAPTURE_TIME_OFFSET + slot]),
+                           float(self._floats[self._PUBLISH_TIME_OFFSET + slot]), pyramid)
+
+    def wait_for_frame(self, last_seq, timeout=None):
+        """通し番号が last_seq より新しいフレームが公開されるまで待って返す"""
+        if self.seq <= last_seq:
+            with self._cond:
+                self._cond.wait_for(lambda: self.seq > last_seq, timeout)
+        if self.seq > last_seq:
+            return self.latest()
+        return None
+
+    def is_intact(self, packet):
+        """取得済みのパケットのスロットがまだ上書きされていないかを返す (読み終えた後に確認する)"""
+        return int(self._header[1 + packet.seq % self.NUM_SLOTS]) == packet.seq
+
+    def close(self):
+        # numpyビューを先に手放さないと共有メモリを閉じられない
+        self._header = self._floats = None
+        self._color_slots = self._depth_slots = []
+        self._shm.close()
+        if self._creator:
+            self._shm.unlink()
@@ -0,0 +1,358 @@
+#
+# ファイル名: frame_source.py
+# 役割: カメラ取得スレッドへフレームを供給するソース (実機RealSense / 録画の再生)
+#       と、実機でのセッション録画 (SessionRecorder)
+#
+# どのソースも同じ使い方ができる:
+#   source.start()              -> 起動 (depth_scale, depth_rois, depth_column_map が確定する)
+#   frame = source.read()       -> FrameData、タイムアウト時は None
+#   source.finished             -> 再生が終端に達したら True
+#   source.stop()
+#
+# 録画セッションの形式 (ディレクトリ):
+#   meta.json         : {"width", "height", "depth_scale", "depth_rois", "depth_column_map", "chunk_size"}
+#   chunk_00000.npz   : color (N,H,W,3) uint8, depth (N,H,W) uint16 (無い場合あり),
+#                       timestamps (N,) float64 [ms], frame_numbers (N,) int64,
+#                       decisions (N,) str (そのフレームに対する判断結果のJSON、録画時のみ)
+#
+
+import json
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# timestamp はカメラのハードウェアタイムスタンプ [ms]
+# capture_time はその取得時刻をシステム時刻 (time.time() 基準の秒) で表した値。
+# タイムスタンプがシステム時刻と比べられない場合は None (公開時刻で代用される)
+FrameData = namedtuple('FrameData', ['color', 'depth', 'timestamp', 'frame_number', 'capture_time'],
+                       defaults=(None,))
+
+SESSION_META_FILE = 'meta.json'
+SESSION_CHUNK_FORMAT = 'chunk_{:05d}.npz'
+
+# タイムスタンプから求めた取得時刻が現在時刻とこれ以上ずれていたら、時計が合っていないとみなす [s]
+CAPTURE_TIME_MAX_SKEW = 1.0
+
+
+class RealSenseSource:
+    """
+    RealSense (RGB+Depth) からフレームを取得するソース。
+    map_rois に RGB画像上のROI {'left': (y1, y2, x1, x2), ...} を渡すと、
+    起動時に位置合わせ前の深度画像の座標へ写して depth_rois に入れる。
+    同時に、深度画像の列をカラー画像の横位置へ写す一次式を depth_column_map に入れる。
+    写せなかった場合は毎フレーム rs.align で位置合わせする (depth_column_map は None)。
+    """
+    def __init__(self, width=640, height=480, fps=30, map_rois=None, roi_distance=0.75):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.map_rois = map_rois
+        self.roi_distance = roi_distance
+        self.depth_scale = 0.001
+        self.depth_rois = None
+        self.depth_column_map = None
+        self.finished = False
+        self._pipeline = None
+        self._align = None
+
+    def start(self):
+        import pyrealsense2 as rs
+        self._rs = rs
+
+        self._pipeline = rs.pipeline()
+        config = rs.config()
+        # ★重要: RGBとDepthの両方を有効化
+        # BGR8はOpenCV用、Z16は深度計算用
+        config.enable_stream(rs.stream.color, self.width, self.height, rs.format.bgr8, self.fps)
+        config.enable_stream(rs.stream.depth, self.width, self.height, rs.format.z16, self.fps)
+        profile = self._pipeline.start(config)
+
+        # 距離計算に必要なスケール情報を取得
+        depth_sensor = profile.get_device().first_depth_sensor()
+        self.depth_scale = depth_sensor.get_depth_scale()
+
+        if self.map_rois:
+            try:
+                self.depth_rois = self._compute_depth_rois(profile)
+                self.depth_column_map = self._compute_depth_column_map(profile)
+            except Exception as e:
+                print(f"[RealSense] 壁ROIの変換に失敗。位置合わせを使用します: {e}")
+                self.depth_rois = None
+                self.depth_column_map = None
+                self._align = rs.align(rs.stream.color)
+        else:
+            self._align = rs.align(rs.stream.color)
+
+    def _compute_depth_rois(self, profile):
+        """
+        ROIの四隅を roi_distance [m] の平面上の点としてRGBカメラ座標へ戻し、
+        外部パラメータで深度カメラ座標へ移してから投影した外接矩形を返す。
+        (D4xxの基線長ではROI幅30pxに対して視差のずれは数px程度)
+        """
+        rs = self._rs
+        color_profile = profile.get_stream(rs.stream.color).as_video_stream_profile()
+        depth_profile = profile.get_stream(rs.stream.depth).as_video_stream_profile()
+        color_intrinsics = color_profile.get_intrinsics()
+        depth_intrinsics = depth_profile.get_intrinsics()
+        color_to_depth = color_profile.get_extrinsics_to(depth_profile)
+        depth_w, depth_h = depth_intrinsics.width, depth_intrinsics.height
+
+        rois = {}
+        for side, (y1, y2, x1, x2) in self.map_rois.items():
+            xs, ys = [], []
+            for px, py in ((x1, y1), (x2, y1), (x1, y2), (x2, y2)):
+                point = rs.rs2_deproject_pixel_to_point(color_intrinsics, [float(px), float(py)], self.roi_distance)
+                point = rs.rs2_transform_point_to_point(color_to_depth, point)
+                dx, dy = rs.rs2_project_point_to_pixel(depth_intrinsics, point)
+                xs.append(dx)
+                ys.append(dy)
+            # 深度画像の範囲内に収める
+            rois[side] = (max(0, int(np.floor(min(ys)))), min(depth_h, int(np.ceil(max(ys)))),
+                          max(0, int(np.floor(min(xs)))), min(depth_w, int(np.ceil(max(xs)))))
+        return rois
+
+    def _compute_depth_column_map(self, profile):
+        """
+        深度画像の中央の行の列を roi_distance [m] の平面上の点としてカラーカメラ座標へ移して投影し、
+        深度の列 x -> カラー画像の横位置 u (-1.0 左端 〜 1.0 右端) の一次式 u = scale * x + offset を
+        最小二乗で求めて (scale, offset) を返す。
+        (D4xxは深度の画角 (約87°) がカラー (約69°) より広いので、左右の割合で換算すると4割ほどずれる)
+        """
+        rs = self._rs
+        color_profile = profile.get_stream(rs.stream.color).as_video_stream_profile()
+        depth_profile = profile.get_stream(rs.stream.depth).as_video_stream_profile()
+        color_intrinsics = color_profile.get_intrinsics()
+        depth_intrinsics = depth_profile.get_intrinsics()
+        depth_to_color = depth_profile.get_extrinsics_to(color_profile)
+
+        depth_xs = np.linspace(0, depth_intrinsics.width - 1, 9)
+        center_y = (depth_intrinsics.height - 1) / 2
+        color_us = []
+        for dx in depth_xs:
+            point = rs.rs2_deproject_pixel_to_point(depth_intrinsics, [float(dx), center_y], self.roi_distance)
+            point = rs.rs2_transform_point_to_point(depth_to_color, point)
+            cx, _ = rs.rs2_project_point_to_pixel(color_intrinsics, point)
+            color_us.append(cx / (color_intrinsics.width / 2) - 1.0)
+        scale, offset = np.polyfit(depth_xs, color_us, 1)
+        return float(scale), float(offset)
+
+    def read(self, timeout_ms=1000):
+        try:
+            frames = self._pipeline.wait_for_frames(timeout_ms=timeout_ms)
+        except RuntimeError:
+            print("[カメラ] フレーム取得タイムアウト")
+            return None
+
+        # アライメント処理 (ROI変換が使えない時のみ)
+        if self._align is not None:
+            frames = self._align.process(frames)
+        color_frame = frames.get_color_frame()
+        depth_frame = frames.get_depth_frame()
+        if not color_frame or not depth_frame:
+            return None
+
+        timestamp = color_frame.get_timestamp()
+        return FrameData(np.asanyarray(color_frame.get_data()),
+                         np.asanyarray(depth_frame.get_data()),
+                         timestamp,
+                         color_frame.get_frame_number(),
+                         self._capture_time(color_frame, timestamp))
+
+    def _capture_time(self, frame, timestamp):
+        """
+        タイムスタンプの基準がシステム時刻 (global_time: カメラの時計をホストの時計に合わせた値、
+        system_time: ホストが受け取った時刻) なら、取得時刻 [s] (time.time() 基準) を返す。
+        ハードウェアの時計 (hardware_clock) など、システム時刻と比べられない場合は None。
+        """
+        rs = self._rs
+        domain = frame.get_frame_timestamp_domain()
+        if domain not in (rs.timestamp_domain.global_time, rs.timestamp_domain.system_time):
+            return None
+        capture_time = timestamp / 1000.0
+        if abs(time.time() - capture_time) > CAPTURE_TIME_MAX_SKEW:
+            return None
+        return capture_time
+
+    def stop(self):
+        if self._pipeline is not None:
+            self._pipeline.stop()
+            self._pipeline = None
+
+
+class RecordedSource:
+    """
+    録画セッション (frame_source.py 冒頭の形式) を再生するソース。
+    realtime=True なら録画時のタイムスタンプ間隔で、False なら最速で再生する。
+    loop=True なら終端で先頭に戻る。
+    """
+    def __init__(self, path, realtime=True, loop=False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.depth_scale = 0.001
+        self.depth_rois = None
+        self.depth_column_map = None
+        self.finished = False
+        self._chunk_paths = []
+        self._chunk_index = 0
+        self._chunk = None
+        self._pos = 0
+        self._base = None  # (最初のタイムスタンプ[ms], 再生開始時刻[s])
+
+    def start(self):
+        with open(os.path.join(self.path, SESSION_META_FILE)) as f:
+            meta = json.load(f)
+        self.depth_scale = meta.get('depth_scale', 0.001)
+        rois = meta.get('depth_rois')
+        self.depth_rois = {side: tuple(roi) for side, roi in rois.items()} if rois else None
+        column_map = meta.get('depth_column_map')
+        self.depth_column_map = tuple(column_map) if column_map else None
+
+        self._chunk_paths = sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.startswith('chunk_') and name.endswith('.npz'))
+        if not self._chunk_paths:
+            raise FileNotFoundError(f"録画チャンクがありません: {self.path}")
+        print(f"[録画再生]: {self.path} ({len(self._chunk_paths)}チャンク, realtime={self.realtime})")
+
+    def _load_chunk(self, index):
+        with np.load(self._chunk_paths[index]) as data:
+            self._chunk = {key: data[key] for key in data.files}
+        self._chunk_index = index
+        self._pos = 0
+
+    def read(self, timeout_ms=1000):
+        if self.finished:
+            return None
+        if self._chunk is None or self._pos >= len(self._chunk['timestamps']):
+            next_index = 0 if self._chunk is None else self._chunk_index + 1
+            if next_index >= len(self._chunk_paths):
+                if not self.loop:
+                    self.finished = True
+                    return None
+                next_index = 0
+                self._base = None
+            self._load_chunk(next_index)
+
+        chunk, i = self._chunk, self._pos
+        self._pos += 1
+        timestamp = float(chunk['timestamps'][i])
+
+        if self.realtime:
+            if self._base is None:
+                self._base = (timestamp, time.time())
+            wait_time = (timestamp - self._base[0]) / 1000.0 - (time.time() - self._base[1])
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+        depth = chunk['depth'][i] if 'depth' in chunk else None
+        return FrameData(chunk['color'][i], depth, timestamp, int(chunk['frame_numbers'][i]))
+
+    def stop(self):
+        self._chunk = None
+
+
+class SessionRecorder:
+    """
+    フレームと判断結果を録画セッション (RecordedSource で再生できる形式) として書き出す。
+    record() はコピーしてキューへ入れるだけで、圧縮・書き込みは専用スレッドが行う。
+    キューが一杯 (SDカードが遅い等) の時は待たずにそのフレームを捨てる。
+    every_n で間引き (2なら2フレームに1枚) できる。
+    """
+    def __init__(self, path, every_n=1, chunk_size=30, queue_size=30, record_depth=True):
+        self.path = path
+        self.every_n = max(1, int(every_n))
+        self.chunk_size = chunk_size
+        self.record_depth = record_depth
+        self.recorded = 0   # キューへ入れた枚数
+        self.dropped = 0    # キューが一杯で捨てた枚数
+        self.written = 0    # ファイルへ書き出した枚数
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._count = 0
+        self._chunk_index = 0
+        self._thread = None
+
+    def start(self, depth_scale=0.001, depth_rois=None, width=0, height=0, depth_column_map=None):
+        os.makedirs(self.path, exist_ok=True)
+        meta = {
+            'width': width,
+            'height': height,
+            'depth_scale': depth_scale,
+            'depth_rois': {side: list(roi) for side, roi in depth_rois.items()} if depth_rois else None,
+            'depth_column_map': list(depth_column_map) if depth_column_map else None,
+            'chunk_size': self.chunk_size,
+        }
+        with open(os.path.join(self.path, SESSION_META_FILE), 'w') as f:
+            json.dump(meta, f)
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+        print(f"[録画]: {self.path} へ記録を開始します (every_n={self.every_n})")
+
+    def record(self, color, depth, timestamp, frame_number, decisions=None, is_intact=None):
+        """
+        1フレームを記録する (呼び出し側を待たせない)。記録したら True。
+        is_intact を渡すとコピーの後に呼び、False (コピー中に元のバッファが上書きされた) なら捨てる。
+        """
+        self._count += 1
+        if (self._count - 1) % self.every_n != 0:
+            return False
+        if self._queue.full():
+            self.dropped += 1
+            return False
+        depth = depth.copy() if (self.record_depth and depth is not None) else None
+        item = (color.copy(), depth, float(timestamp), int(frame_number),
+                json.dumps(decisions or {}))
+        if is_intact is not None and not is_intact():
+            self.dropped += 1
+            return False
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.recorded += 1
+        return True
+
+    def _writer_loop(self):
+        chunk = []
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                self._write_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._write_chunk(chunk)
+
+    def _write_chunk(self, chunk):
+        colors, depths, timestamps, frame_numbers, decisions = zip(*chunk)
+        arrays = {
+            'color': np.stack(colors),
+            'timestamps': np.array(timestamps, dtype=np.float64),
+            'frame_numbers': np.array(frame_numbers, dtype=np.int64),
+            'decisions': np.array(decisions),
+        }
+        if all(d is not None for d in depths):
+            arrays['depth'] = np.stack(depths)
+        file_path = os.path.join(self.path, SESSION_CHUNK_FORMAT.format(self._chunk_index))
+        try:
+            np.savez_compressed(file_path, **arrays)
+            self.written += len(chunk)
+        except OSError as e:
+            print(f"[録画] 書き込みエラー: {e}")
+        self._chunk_index += 1
+
+    def stop(self):
+        """キューに残ったフレームを書き出してから終了する"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        print(f"[録画]: 終了 (書き出し {self.written}枚, 破棄 {self.dropped}枚)")
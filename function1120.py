@@ -1,53 +1,221 @@
 #ライブラリのインポート
 import cv2
 import numpy as np
-import math
 import time
-import pyrealsense2 as rs
+import queue
+import threading
 import serial
 
+from frame_source import RealSenseSource
+from vision_utils import estimate_vanishing_point, ransac_vanishing_point, SteeringProcessor, SteeringRoi, make_line_backend
+from vision_utils import ChangeGate, GravityEngine, GRAVITY_BAND_NAMES, depth_corridor_offset
+from optical_flow_utils import BandFlowTracker, WaterfallGrid, crop_resize_strip
+
 #robot_vision_debug2からのパラメータ
 RESIZE_WIDTH = 240
 MIN_NOISE_AREA = 45 
 
+# 消失点の推定方式
+#   'median': 全交点のx座標の中央値 (従来方式。線の数の二乗に比例して重くなる)
+#   'ransac': 線ペアを固定回数だけ試し、線の長さで重み付け投票 (計算量が一定、信頼度も出る)
+VP_ESTIMATOR_MODE = 'median'
+
+# 操舵の線分検出方式 ('hough' / 'lsd' / 'fld')。benchmark_line_backends.py で比較して選ぶ
+LINE_BACKEND = 'hough'
+
+# True: 前回うまく斜め線が取れた行の帯だけを処理する (失敗が続くと全画面に戻る)
+USE_STEERING_ROI = False
+
+# True: 前回処理したフレームからほとんど変化が無ければ、操舵の処理を省いて前回の結果を使い回す
+#       (停止中・低速時のCPU節約。ヒット/ミス数は終了時に表示)
+USE_CHANGE_GATE = False
+
+# True: 水検出のオプティカルフローを左右の帯だけで行う (元解像度から帯を切り出して縮小し、
+#       左右を別々のトラッカーで追う。縮小・フローの画素数がちょうど半分 (360列中180列) になる)
+USE_SIDE_BAND_FLOW = False
+
+# 壁ROIを深度画像の座標へ写す時に仮定する壁までの距離 [m] (壁制御の目標距離付近)
+WALL_ROI_NOMINAL_DISTANCE = 0.75
+
+# ===================================================================
+# 補助関数: 結果に付ける元フレームの情報 (遅延計測用)
+# ===================================================================
+def make_result_meta(packet):
+    """
+    結果を計算した元フレームの情報を返す。
+    frame_number / timestamp はカメラのハードウェア値、
+    capture_time はカメラの取得時刻 (分からなければ公開時刻)、publish_time は公開時刻、
+    decision_time は結果が出た時刻 (いずれも time.time() 基準)。
+    """
+    return {
+        'frame_number': packet.frame_number,
+        'timestamp': packet.timestamp,
+        'capture_time': packet.capture_time,
+        'publish_time': packet.publish_time,
+        'decision_time': time.time(),
+    }
+
+def format_latency(meta, write_time):
+    """
+    取得→判断→送信の遅延をログ用の文字列にする。
+    取得時刻が分からない (公開時刻で代用した) 場合は、起点を「公開」と表示する。
+    """
+    if not meta:
+        return "遅延: --"
+    decision_to_write = (write_time - meta['decision_time']) * 1000
+    if meta['capture_time'] < meta['publish_time']:
+        capture_to_decision = (meta['decision_time'] - meta['capture_time']) * 1000
+        capture_to_publish = (meta['publish_time'] - meta['capture_time']) * 1000
+        start = f"取得→判断 {capture_to_decision:4.0f}ms (うち取得→公開 {capture_to_publish:3.0f}ms)"
+    else:
+        publish_to_decision = (meta['decision_time'] - meta['publish_time']) * 1000
+        start = f"公開→判断 {publish_to_decision:4.0f}ms"
+    return f"#{meta['frame_number']} {start}, 判断→送信 {decision_to_write:4.0f}ms"
+
+def stale_result_command(meta, max_age, halt_age, now=None):
+    """
+    結果が古すぎる場合に代わりに送る安全側のコマンドを返す (十分新しければ None)。
+    元フレームの取得から max_age 秒を超えていれば 'S' (直進)、
+    halt_age 秒を超えているか結果がまだ無ければ 'H' (停止)。
+    """
+    if not meta:
+        return "H"
+    if now is None:
+        now = time.time()
+    age = now - meta['capture_time']
+    if age > halt_age:
+        return "H"
+    if age > max_age:
+        return "S"
+    return None
+
+# ===================================================================
+# 補助クラス: 処理段ごとの実行レートを自動調整するガバナー
+# ===================================================================
+class RateGovernor:
+    """
+    各処理段 (カメラ・操舵・オプティカルフロー・壁制御) の処理時間とデッドライン超過を計測し、
+    実行レートを段ごとの範囲 [min_fps, max_fps] 内で自動調整する。
+
+    - 段ごとの希望レート = 基準レート x 優先度 (範囲内に制限)
+    - 全段の負荷 (処理時間 x レート の合計、1.0 = CPU 1コア分) が cpu_budget を超えたら、
+      優先度の低い段ほど大きくレートを下げる
+    - 周期内に処理が終わらなかった (デッドライン超過) 段はすぐにレートを下げ、
+      処理時間で回せる上限を超えないようにする
+    スレッド版ランタイムで shared_state['governor'] に入れて使う。
+    """
+    SMOOTHING = 0.2        # レート・処理時間の指数移動平均の係数
+    MISS_BACKOFF = 0.8     # デッドライン超過時にレートへ掛ける係数
+
+    def __init__(self, cpu_budget=0.8):
+        self.cpu_budget = cpu_budget
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, target_fps, min_fps, max_fps, priority=1.0):
+        """処理段を登録する (スレッド開始時に、そのスレッドの基準レートと範囲で呼ぶ)"""
+        with self._lock:
+            old = self._stages.get(name)
+            self._stages[name] = {
+                'target_fps': target_fps, 'min_fps': min_fps, 'max_fps': max_fps,
+                'priority': old['priority'] if old else priority,
+                'fps': target_fps, 'cost': old['cost'] if old else 0.0,
+                'cycles': 0, 'misses': 0,
+            }
+
+    def remove_stage(self, name):
+        """動いていない段 (壁制御など) を負荷の計算から外す"""
+        with self._lock:
+            self._stages.pop(name, None)
+
+    def set_priority(self, name, priority):
+        """段の優先度を変える (1.0が基準。大きいほどレートと予算が増える)"""
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is not None:
+                stage['priority'] = priority
+
+    def finish(self, name, processing_time):
+        """1周期分の処理時間[s]を報告し、次の周期までの実行間隔[s]を返す"""
+        with self._lock:
+            stage = self._stages[name]
+            stage['cycles'] += 1
+            if stage['cycles'] == 1:
+                stage['cost'] = processing_time
+            else:
+                stage['cost'] += self.SMOOTHING * (processing_time - stage['cost'])
+            if processing_time > 1.0 / stage['fps']:
+                stage['misses'] += 1
+                stage['fps'] = max(stage['min_fps'], stage['fps'] * self.MISS_BACKOFF)
+            self._rebalance()
+            return 1.0 / stage['fps']
+
+    def _rebalance(self):
+        desired = {}
+        load = 0.0
+        for name, stage in self._stages.items():
+            fps = stage['target_fps'] * stage['priority']
+            desired[name] = min(max(fps, stage['min_fps']), stage['max_fps'])
+            load += stage['cost'] * desired[name]
+
+        scale = self.cpu_budget / load if load > self.cpu_budget else 1.0
+        for name, stage in self._stages.items():
+            # 優先度が高い段ほど縮小を弱める (優先度2なら縮小率の平方根)
+            fps = desired[name] * scale ** (1.0 / max(stage['priority'], 0.1))
+            if stage['cost'] > 0:
+                fps = min(fps, 1.0 / stage['cost'])
+            fps = min(max(fps, stage['min_fps']), stage['max_fps'])
+            stage['fps'] += self.SMOOTHING * (fps - stage['fps'])
+
+    def summary(self):
+        """ログ用: 段ごとの現在レート・平均処理時間・デッドライン超過数"""
+        with self._lock:
+            return ", ".join(
+                f"{name} {stage['fps']:.1f}fps ({stage['cost'] * 1000:.0f}ms, miss {stage['misses']}/{stage['cycles']})"
+                for name, stage in self._stages.items())
+
 # ===================================================================
 # スレッド 1: RealSense統合取得スレッド (変更箇所)
 # ===================================================================
-#アライメントを削除してうまくいくか試す
-def realsense_capture_thread(shared_state, lock):
+def realsense_capture_thread(shared_state, lock, source=None):
+    """
+    source: frame_source.py のフレームソース。省略時は実機のRealSense。
+    録画を再生する場合は RecordedSource を渡す (終端に達したら全体を停止する)。
+    """
     # --- RealSense設定 ---
     W, H = 640, 480
     HARDWARE_FPS = 30    # デバイス側は30fpsで安定させる
-    TARGET_FPS = 20      # ソフトウェア側で20fpsとして処理する
-    MIN_INTERVAL = 1.0 / TARGET_FPS
+    TARGET_FPS = 20      # ソフトウェア側で20fpsとして処理する (ガバナー使用時は基準値)
+    MIN_FPS, MAX_FPS = 10, HARDWARE_FPS
+    MIN_INTERVAL_MS = 1000.0 / TARGET_FPS
     
-    print(f"[カメラ取得スレッド]: RealSenseの起動を試みます... (HW:{HARDWARE_FPS}fps -> SW:{TARGET_FPS}fps)")
+    governor = shared_state.get('governor')
+    if governor is not None:
+        governor.add_stage('capture', TARGET_FPS, MIN_FPS, MAX_FPS)
     
-    pipeline = rs.pipeline()
-    config = rs.config()
+    if source is None:
+        # 壁制御のROI(RGB座標)を起動時に1回だけ深度画像の座標へ写しておき、
+        # 毎フレームの位置合わせ(rs.align)を省略する。
+        wall_rois = {side: wall_roi(H, W, side) for side in ('left', 'right')}
+        source = RealSenseSource(W, H, HARDWARE_FPS, map_rois=wall_rois,
+                                 roi_distance=WALL_ROI_NOMINAL_DISTANCE)
     
-    # ★重要: RGBとDepthの両方を有効化
-    # BGR8はOpenCV用、Z16は深度計算用
-    config.enable_stream(rs.stream.color, W, H, rs.format.bgr8, HARDWARE_FPS)
-    config.enable_stream(rs.stream.depth, W, H, rs.format.z16, HARDWARE_FPS)
+    print(f"[カメラ取得スレッド]: {type(source).__name__} の起動を試みます... (HW:{HARDWARE_FPS}fps -> SW:{TARGET_FPS}fps)")
     
     try:
-        profile = pipeline.start(config)
-        
-        # 距離計算に必要なスケール情報を取得
-        depth_sensor = profile.get_device().first_depth_sensor()
-        depth_scale = depth_sensor.get_depth_scale()
+        source.start()
         
-        # 画像位置合わせ用 (RGBの画角にDepthを合わせる)
-        align = rs.align(rs.stream.color)
-        
-        # スケールを共有しておく
-        with lock:
-            shared_state['depth_scale'] = depth_scale
+        # フレーム交換器 (グローバルロックを使わずにフレームを公開する)
+        frames_exchange = shared_state['frames']
+        frames_exchange.depth_scale = source.depth_scale
+        frames_exchange.depth_rois = source.depth_rois
+        frames_exchange.depth_column_map = source.depth_column_map
+        if source.depth_rois:
+            print(f"[カメラ取得スレッド]: 深度画像上の壁ROI: {source.depth_rois}")
             
-        print("[カメラ取得スレッド]: RealSense 起動完了。")
+        print("[カメラ取得スレッド]: 起動完了。")
         
-        last_update_time = 0
+        last_timestamp = None
         
         while True:
             with lock:
@@ -55,52 +223,38 @@ def realsense_capture_thread(shared_state, lock):
                     break
             
             # 1. フレーム待機 (ここは30fpsで回る)
-            try:
-                frames = pipeline.wait_for_frames(timeout_ms=1000)
-            except RuntimeError:
-                print("[カメラ] フレーム取得タイムアウト")
+            frame = source.read(timeout_ms=1000)
+            if frame is None:
+                if source.finished:
+                    print("[カメラ取得スレッド]: 録画の再生が終了しました。全体を停止します。")
+                    with lock:
+                        shared_state['stop'] = True
+                    break
                 continue
             
-            # 2. FPS間引き処理
-            current_time = time.time()
-            if current_time - last_update_time < MIN_INTERVAL:
+            # 2. FPS間引き処理 (フレームのタイムスタンプ基準なので、録画の最速再生でも同じ間引きになる)
+            # ※録画のループ再生でタイムスタンプが戻った場合は間引かない
+            if last_timestamp is not None and 0 <= frame.timestamp - last_timestamp < MIN_INTERVAL_MS:
                 # 指定時間経過していなければ、データ更新せずスキップ
                 continue
             
-            last_update_time = current_time
-            
-            # 3. アライメント処理 (少し重いので間引き後に行う)
-            aligned_frames = align.process(frames)
-            color_frame = aligned_frames.get_color_frame()
-            depth_frame = aligned_frames.get_depth_frame()
-            
-            if not color_frame or not depth_frame:
-                continue
+            last_timestamp = frame.timestamp
             
-            # 4. Numpy配列化
-            color_image = np.asanyarray(color_frame.get_data())
-            depth_image = np.asanyarray(depth_frame.get_data())
-            
-            # 5. 共有メモリ更新
-            with lock:
-                # RGB画像 (操舵・水検知用)
-                shared_state['prev_frame'] = shared_state['latest_frame']
-                shared_state['latest_frame'] = color_image
-                
-                # Depth画像 (壁制御用)
-                shared_state['latest_depth'] = depth_image
-                
-                # フラグ更新
-                shared_state['new_frame_flag'] = True
+            # 3. フレーム公開 (RGB: 操舵・水検知用, Depth: 壁制御用)
+            # トリプルバッファへ書き込むだけなので、他スレッドを待たせない
+            publish_start = time.time()
+            frames_exchange.publish(frame.color, frame.depth, frame.timestamp, frame.frame_number, frame.capture_time)
+            if governor is not None:
+                MIN_INTERVAL_MS = governor.finish('capture', time.time() - publish_start) * 1000.0
 
     except Exception as e:
         print(f"[カメラ取得スレッド] 重大エラー: {e}")
     finally:
         try:
-            pipeline.stop()
+            source.stop()
         except:
             pass
-        print("[カメラ取得スレッド]: RealSenseを停止しました。")
+        print("[カメラ取得スレッド]: カメラを停止しました。")
 
     
 # ===================================================================
@@ -116,146 +270,163 @@ def vision_processing_thread(shared_state, lock):
     CLIP_LIMIT = 15.0
     TILE_GRID_SIZE = (4, 4)
     
-    TARGET_FPS = 3.0
+    TARGET_FPS = 3.0          # ガバナー使用時は基準値
+    MIN_FPS, MAX_FPS = 1.0, 8.0
     INTERVAL = 1.0 / TARGET_FPS
+    FRAME_WAIT_TIMEOUT = 0.1  # 新フレーム待ちの上限 (停止フラグ確認のため)
+    
+    frames_exchange = shared_state['frames']
+    last_seq = 0  # 最後に処理したフレームの通し番号
+    
+    # CLAHE と途中の画像バッファはループの外で1回だけ作って使い回す
+    steering_processor = SteeringProcessor(CLIP_LIMIT, TILE_GRID_SIZE, CANNY_THRESHOLD1, CANNY_THRESHOLD2, MIN_NOISE_AREA)
+    line_backend = make_line_backend(LINE_BACKEND, steering_processor, HOUGH_THRESHOLD, HOUGH_MIN_LINE_LENGTH, HOUGH_MAX_LINE_GAP)
+    steering_roi = SteeringRoi()
+    gravity_engine = GravityEngine()
+    
+    # 変化ゲート (前回の結果の使い回し) と、省略できたCPU時間の見積もり用の処理時間
+    change_gate = ChangeGate() if USE_CHANGE_GATE else None
+    last_result = None  # (steering_success, steering_value, steering_confidence)
+    processing_time_total = 0.0
+    processed_count = 0
+    
+    governor = shared_state.get('governor')
+    if governor is not None:
+        governor.add_stage('vision', TARGET_FPS, MIN_FPS, MAX_FPS)
+    suspended = False
     
     while True:
         start_time = time.time()
         with lock:
             if shared_state['stop']:
                 break
-            # 水検知中(壁追従中)は処理を抑制
-            if shared_state.get('water_detected',False):
-                shared_state['new_frame_flag'] = False
-                time.sleep(0.01)
-                continue
-            
-            if not shared_state.get('new_frame_flag', False):
-                continue
-            
-            # データをコピーしてロック解除
-            shared_state['new_frame_flag'] = False
-            frame = shared_state['latest_frame']
-            
-            if frame is None:
-                continue
+            is_water_detected = shared_state.get('water_detected', False)
+        
+        # 水検知中(壁追従中)は処理を抑制 (溜まったフレームは読み捨てる)
+        # 止まっている間は他の段の予算を削らないよう、ガバナーの負荷計算から外す
+        if is_water_detected:
+            if governor is not None and not suspended:
+                governor.remove_stage('vision')
+            suspended = True
+            last_seq = frames_exchange.seq
+            time.sleep(0.01)
+            continue
+        if suspended:
+            if governor is not None:
+                governor.add_stage('vision', TARGET_FPS, MIN_FPS, MAX_FPS)
+            suspended = False
+        
+        # 新しいフレームが届くまで眠る (ビジーループしない)
+        packet = frames_exchange.wait_for_frame(last_seq, timeout=FRAME_WAIT_TIMEOUT)
+        if packet is None:
+            continue
+        last_seq = packet.seq
+        process_start = time.time()
         
         try:
-            # === 1. リサイズと前処理 ===
-            orig_height, orig_width = frame.shape[:2]
-            aspect_ratio = orig_height / orig_width
-            resize_height = int(RESIZE_WIDTH * aspect_ratio)
-            resized_frame = cv2.resize(frame, (RESIZE_WIDTH, resize_height), interpolation=cv2.INTER_AREA)
-            height, width = resized_frame.shape[:2]
+            # === 1. リサイズと前処理 (フレーム共通の前処理キャッシュから取得) ===
+            gray_frame = packet.view(f'gray@{RESIZE_WIDTH}')
+            height, width = gray_frame.shape[:2]
             image_center_x = width / 2
-            gray_frame= cv2.cvtColor(resized_frame, cv2.COLOR_BGR2GRAY)
             
-            # === 2. 操舵（消失点）検出 ===
-            gray_steering = gray_frame
-            clahe = cv2.createCLAHE(clipLimit=CLIP_LIMIT, tileGridSize=TILE_GRID_SIZE)
-            adjusted = clahe.apply(gray_steering)
-            blurred_again = cv2.GaussianBlur(adjusted, (7, 7), 0)
-            edges = cv2.Canny(blurred_again, CANNY_THRESHOLD1, CANNY_THRESHOLD2)
+            # 重心 (遠/中/近の帯ごと) と深度の通路中心は軽いので毎フレーム計算する
+            gravity = gravity_engine.process(gray_frame)
+            corridor_offset, corridor_confidence = depth_corridor_offset(
+                packet.depth, frames_exchange.depth_scale, width, frames_exchange.depth_column_map)
+            # スロットのバッファを読むのはここまで (以降は縮小済みの別の配列だけを使う)。
+            # 読んでいる間に上書きされていたら、壊れた入力なのでこのフレームを飛ばす
+            if not frames_exchange.is_intact(packet):
+                continue
             
-            num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(edges, connectivity=8)
-            cleaned_edges = np.zeros_like(edges)
-            for i in range(1, num_labels):
-                if stats[i, cv2.CC_STAT_AREA] > MIN_NOISE_AREA:
-                    cleaned_edges[labels == i] = 255
+            # === 2. 変化ゲート: 前回処理したフレームとほぼ同じなら前回の結果を使い回す ===
+            if change_gate is not None and last_result is not None and change_gate.is_unchanged(gray_frame):
+                steering_success, steering_difference, steering_confidence = last_result
+            else:
+                # === 3. 操舵（消失点）検出 ===
+                # ROI版では前回の結果から決めた行の帯だけを処理する
+                roi_y0, roi_y1 = steering_roi.band(height) if USE_STEERING_ROI else (0, height)
             
-            lines = cv2.HoughLinesP(cleaned_edges, 1, np.pi/180, threshold=HOUGH_THRESHOLD, minLineLength=HOUGH_MIN_LINE_LENGTH, maxLineGap=HOUGH_MAX_LINE_GAP)
+                # 線分検出 (hough: CLAHE -> ぼかし -> Canny -> 小さな連結成分の除去 -> HoughLinesP)
+                lines = line_backend.detect(gray_frame[roi_y0:roi_y1])
+                if lines is not None and roi_y0 > 0:
+                    # 帯の座標 -> 全画面の座標
+                    lines = lines + np.array([0, roi_y0, 0, roi_y0], dtype=lines.dtype)
             
-            diagonal_lines = []
-            vp_x = width // 2
-            steering_success = False 
+                vp_x = width // 2
+                steering_success = False 
             
-            if lines is not None:
-                for line in lines:
-                    x1, y1, x2, y2 = line[0]
-                    angle_rad = math.atan2(y2 - y1, x2 - x1)
-                    angle_deg = math.degrees(angle_rad)
-                    abs_angle_deg = abs(angle_deg)
-
-                    is_horizontal = (abs_angle_deg <= 10) or (abs_angle_deg >= 175)
-                    is_vertical = (50 <= abs_angle_deg <= 130)
-                    
-                    if is_horizontal or is_vertical or x1 == x2:
-                        continue
-                    m = (y2 - y1) / (x2 - x1)
-                    c = y1 - m * x1
-                    diagonal_lines.append((m, c))
+                # 斜め線の抽出と交点計算はベクトル化版 (vision_utils) で行う
+                if VP_ESTIMATOR_MODE == 'ransac':
+                    vanishing_point_x, steering_confidence = ransac_vanishing_point(lines, width, height)
+                else:
+                    vanishing_point_x = estimate_vanishing_point(lines, width, height)
+                    steering_confidence = 1.0 if vanishing_point_x is not None else 0.0
+                if USE_STEERING_ROI:
+                    # 帯での結果を検証し、次のフレームの帯を決める
+                    vanishing_point_x = steering_roi.update(lines, vanishing_point_x, height)
+                if vanishing_point_x is not None:
+                    vp_x = vanishing_point_x
+                    steering_success = True 
+            
+                steering_difference = vp_x - image_center_x
             
-            intersection_points = []
-            if len(diagonal_lines) >= 2:
-                for i in range(len(diagonal_lines)):
-                    for j in range(i + 1, len(diagonal_lines)):
-                        m1, c1 = diagonal_lines[i]
-                        m2, c2 = diagonal_lines[j]
-                        if abs(m1 - m2) < 1e-5 or m1*m2 >0 : continue
-                        x = (c2 - c1) / (m1 - m2)
-                        y = m1 * x + c1
-                        if -width < x < width * 2 and -height < y < height * 2:
-                            intersection_points.append((x, y))
-            if intersection_points:
-                x_coords = [p[0] for p in intersection_points]
-                vp_x = int(np.median(x_coords))
-                steering_success = True 
+                # === 4. フォールバック処理 (重心検出) ===
+                if not steering_success:
+                    steering_difference = gravity.offset
+                    steering_confidence = 0.0
             
-            steering_difference = vp_x - image_center_x
+                processing_time_total += time.time() - process_start
+                processed_count += 1
+                last_result = (steering_success, steering_difference, steering_confidence)
             
-            # === 3. フォールバック処理 (重心検出) ===
-            if not steering_success:
-                inverted_array = 255 - gray_frame
-                total_weight = np.sum(inverted_array)
-                center_x = width / 2 
-                if total_weight > 0:
-                    x_coords = np.arange(width)
-                    center_x = np.sum(x_coords * np.sum(inverted_array, axis=0)) / total_weight
-
-                gravity_difference = center_x - image_center_x
+            with lock:
+                shared_state['steering_success'] = steering_success
+                shared_state['steering_value'] = steering_difference
+                shared_state['steering_confidence'] = steering_confidence
+                shared_state['steering_meta'] = make_result_meta(packet)
+                shared_state['gravity_value'] = gravity.offset
+                shared_state['gravity_confidence'] = gravity.confidence
+                shared_state['gravity_bands'] = dict(zip(GRAVITY_BAND_NAMES, gravity.band_offsets.tolist()))
+                shared_state['corridor_value'] = corridor_offset
+                shared_state['corridor_confidence'] = corridor_confidence
                 
-                with lock:
-                    shared_state['steering_success'] = False
-                    shared_state['steering_value'] = gravity_difference
-            else:
-                with lock:
-                    shared_state['steering_success'] = True
-                    shared_state['steering_value'] = steering_difference
-                    
         except Exception as e:
             print(f"[画像処理スレッド] エラー: {e}")
             pass
         
+        if governor is not None:
+            INTERVAL = governor.finish('vision', time.time() - process_start)
         elapsed = time.time() - start_time
         wait_time = INTERVAL - elapsed
         if wait_time > 0:
             time.sleep(wait_time)
+    if change_gate is not None:
+        average_time = processing_time_total / processed_count if processed_count else 0.0
+        print(f"[画像処理スレッド]: 変化ゲート {change_gate.summary()}, "
+              f"省略した処理 約{change_gate.hits * average_time:.1f}秒")
     print("[画像処理スレッド]: 終了しました。")
     
 # ===================================================================
 # スレッド3: オプティカルフローによる水の検出
 # ===================================================================
-
-def analyze_trajectory(track):
-    TRAJECTORY_MIN_DY = 20.0 
-    TRAJECTORY_DRIFT_RATIO = 0.5
-    start_point = track[0]; end_point = track[-1]
-    start_x, start_y = start_point; end_x, end_y = end_point
-    dx = end_x - start_x; dy = end_y - start_y
-    if dy < TRAJECTORY_MIN_DY: return False
-    if dy == 0: return False
-    drift_ratio = abs(dx) / dy
-    if drift_ratio > TRAJECTORY_DRIFT_RATIO: return False
-    return True
-
 def optical_flow_water_detection(shared_state, lock):
     RESIZE_WIDTH = 360
-    TARGET_FPS = 10.0
+    TARGET_FPS = 10.0         # ガバナー使用時は基準値
+    MIN_FPS, MAX_FPS = 4.0, 15.0
     INTERVAL = 1.0 / TARGET_FPS
     TRACK_MAX_LEN = 50
+    TRAJECTORY_MIN_DY = 20.0       # 滝とみなす下向きの移動量 [px]
+    TRAJECTORY_DRIFT_RATIO = 0.5   # 許容する横ずれの比 |dx| / dy
+    TRAJECTORY_MIN_POINTS = 2
+    PRECURSOR_MIN_DY = 5.0         # 水に近づいている兆候とみなす下向きの移動量 [px] (TRAJECTORY_MIN_DY 未満の軌跡)
+    PRECURSOR_MIN_TRACKS = 3       # 兆候とみなす軌跡の数
+    TRACK_CAPACITY = 400      # 同時に保持する軌跡の上限 (超える時は動きの最も小さい既存の軌跡を捨てて新規点を入れる)
     MIN_TRACKS = 40
     RE_DETECT_INTERVAL = 10
     DETECTION_TTL = 15
+    WATERFALL_CELL_SIZE = 20  # 検出メモリのセルの大きさ [px] (360pxの2/9=80, 7/9=280 がセルの境界になる)
+    SIDE_BAND_MARGIN = 10     # 帯モードで中央帯側に付ける余白 [px] (帯の端が 640->360 の縮小の区切り 9px の倍数になる値)
+    FRAME_WAIT_TIMEOUT = 0.1  # 新フレーム待ちの上限 (停止フラグ確認のため)
     
     feature_params = dict(maxCorners=100, qualityLevel=0.03, minDistance=10, blockSize=7)
     lk_params = dict(winSize=(10, 10), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
@@ -263,11 +434,25 @@ def optical_flow_water_detection(shared_state, lock):
     width_2_9 = RESIZE_WIDTH * 2 // 9
     width_7_9 = RESIZE_WIDTH * 7 // 9
     
-    active_tracks = []
+    if USE_SIDE_BAND_FLOW:
+        # 左右の帯 (中央帯との境界から LK 窓の余白を付けた範囲) を別々のトラッカーで追う
+        # (軌跡数・特徴点数の予算は全体モードと同じになるよう左右で半分ずつ)
+        strip_ranges = [(0, width_2_9 + SIDE_BAND_MARGIN), (width_7_9 - SIDE_BAND_MARGIN, RESIZE_WIDTH)]
+        strip_feature_params = dict(feature_params, maxCorners=feature_params['maxCorners'] // 2)
+        trackers = [BandFlowTracker(TRACK_CAPACITY // 2, TRACK_MAX_LEN, MIN_TRACKS // 2, lk_params, strip_feature_params,
+                                    (width_2_9, width_7_9), [(0, width_2_9), (width_7_9, RESIZE_WIDTH)], x_offset=x_start)
+                    for x_start, _ in strip_ranges]
+    else:
+        trackers = [BandFlowTracker(TRACK_CAPACITY, TRACK_MAX_LEN, MIN_TRACKS, lk_params, feature_params,
+                                    (width_2_9, width_7_9), [(0, width_2_9), (width_7_9, RESIZE_WIDTH)])]
     frame_idx = 0
-    waterfall_memory = {}
-    resize_height = 0
-    old_gray = None
+    waterfall_grid = None     # 検出メモリ (最初のフレームで画像サイズから作る)
+    frames_exchange = shared_state['frames']
+    last_seq = 0  # 最後に処理したフレームの通し番号
+    
+    governor = shared_state.get('governor')
+    if governor is not None:
+        governor.add_stage('optical_flow', TARGET_FPS, MIN_FPS, MAX_FPS)
     
     while True:
         loop_start_time = time.time()
@@ -278,106 +463,78 @@ def optical_flow_water_detection(shared_state, lock):
             # 壁追従中も水を監視し続けるか、あるいは止めるかは要調整
             # ここでは動き続ける設定
             
-            # 最新フレームの取得
-            if shared_state['latest_frame'] is None:
-                time.sleep(0.1)
-                continue
-            frame = shared_state['latest_frame'].copy() # 安全のためコピー
+        # 最新フレームの取得 (同じフレームを2回処理しないよう、新着まで待つ)
+        packet = frames_exchange.wait_for_frame(last_seq, timeout=FRAME_WAIT_TIMEOUT)
+        if packet is None:
+            continue
+        last_seq = packet.seq
+        process_start = time.time()
 
         try:
             # --- 1. リサイズ ---
-            if resize_height == 0:
-                orig_height, orig_width = frame.shape[:2]
-                aspect_ratio = orig_height / orig_width
-                resize_height = int(RESIZE_WIDTH * aspect_ratio)
-                if resize_height == 0: continue
-
-            latest_resized_frame = cv2.resize(frame, (RESIZE_WIDTH, resize_height), interpolation=cv2.INTER_AREA)
-            frame_gray = cv2.cvtColor(latest_resized_frame, cv2.COLOR_BGR2GRAY)
-            
+            if USE_SIDE_BAND_FLOW:
+                # 左右の帯だけを元解像度から切り出して縮小 (中央の画素は縮小もフローもしない)
+                gray_full = packet.view('gray')
+                frame_grays = [crop_resize_strip(gray_full, x_start, x_end, RESIZE_WIDTH) for x_start, x_end in strip_ranges]
+            else:
+                # フレーム共通の前処理キャッシュから取得、元画像のコピーは不要
+                frame_grays = [packet.view(f'gray@{RESIZE_WIDTH}')]
+            # 縮小中にスロットが上書きされていたら、壊れた画像で追跡しないようこのフレームを飛ばす
+            # (縮小後の画像は別の配列なので、以降は上書きの影響を受けない)
+            if not frames_exchange.is_intact(packet):
+                continue
+
+            # --- 2. オプティカルフロー (追跡失敗・中央帯に入った軌跡はまとめて削除) ---
+            redetect = frame_idx % RE_DETECT_INTERVAL == 0
+            for tracker, frame_gray in zip(trackers, frame_grays):
+                tracker.step(frame_gray, redetect)
+
             #初回の場合は前フレームがないのでスキップ
-            if old_gray is None:
-                old_gray = frame_gray
+            if waterfall_grid is None:
+                waterfall_grid = WaterfallGrid(RESIZE_WIDTH, frame_grays[0].shape[0], WATERFALL_CELL_SIZE, DETECTION_TTL)
                 continue
 
-            # --- 2. オプティカルフロー ---
-            new_tracks = []
-            if active_tracks:
-                p0 = np.float32([tr[-1] for tr in active_tracks]).reshape(-1, 1, 2)
-                p1, st, err = cv2.calcOpticalFlowPyrLK(old_gray, frame_gray, p0, None, **lk_params)
-                for i, (track, (new_point, status)) in enumerate(zip(active_tracks, zip(p1, st))):
-                    if status[0] == 0: 
-                        continue
-                    new_point_tuple = tuple(new_point.ravel())
-                    new_x = new_point_tuple[0]
-                    
-                    if width_2_9 < new_x < width_7_9: 
-                        continue
-                    track.append(new_point_tuple)
-                    if len(track) > TRACK_MAX_LEN: 
-                        track.pop(0)
-                    new_tracks.append(track)
-            active_tracks = new_tracks
+            # 全軌跡をまとめて判定し、滝らしい軌跡の最新点だけを取り出す
+            candidate_end_points = np.concatenate([
+                tracker.candidate_points(TRAJECTORY_MIN_DY, TRAJECTORY_DRIFT_RATIO, TRAJECTORY_MIN_POINTS)
+                for tracker in trackers])
                     
-            if len(active_tracks) < MIN_TRACKS or frame_idx % RE_DETECT_INTERVAL == 0:
-                detection_mask = np.zeros(frame_gray.shape, dtype=np.uint8)
-                detection_mask[:, 0:width_2_9] = 255
-                detection_mask[:, width_7_9:RESIZE_WIDTH] = 255
-                new_points = cv2.goodFeaturesToTrack(frame_gray, mask=detection_mask, **feature_params)
-                
-                if new_points is not None:
-                    for p in new_points: 
-                        active_tracks.append([tuple(p.ravel())])
-                    
-            candidate_tracks = [] 
-            for track in active_tracks:
-                if len(track) < 2:
-                    continue
-                if analyze_trajectory(track):
-                    candidate_tracks.append(track)
-                    
-            expired_cells = []
-            for cell in waterfall_memory:
-                waterfall_memory[cell] -= 1
-                if waterfall_memory[cell] <= 0: 
-                    expired_cells.append(cell)
-            for cell in expired_cells: 
-                del waterfall_memory[cell]
-            for track in candidate_tracks:
-                if not track: 
-                    continue
-                end_point = track[-1]
-                key = (int(end_point[0]), int(end_point[1]))
-                waterfall_memory[key] = DETECTION_TTL
+            # 検出メモリ: 全セルの TTL を1減らし、滝らしい軌跡の最新点があるセルを最大値に戻す
+            waterfall_grid.update(candidate_end_points)
                 
             frame_idx += 1
             
-            left_detections = 0
-            right_detections = 0
-                    
-            if waterfall_memory:
-                for (center_x, center_y), ttl in waterfall_memory.items():
-                    if center_x <= width_2_9:
-                        left_detections += 1
-                    elif center_x >= width_7_9: 
-                        right_detections += 1
+            # 左右の帯 (x <= 2/9, x >= 7/9) のセルに記憶中の滝があるか
+            left_detected = waterfall_grid.active_in_columns(0, width_2_9 + 1)
+            right_detected = waterfall_grid.active_in_columns(width_7_9, RESIZE_WIDTH)
                     
+            water_meta = make_result_meta(packet)
             with lock:
-                if left_detections > 0:
+                shared_state['water_meta'] = water_meta
+                if left_detected:
                     shared_state['water_detected'] = True
                     shared_state['wall_side'] = 'left'
-                elif right_detections > 0:
+                elif right_detected:
                     shared_state['water_detected'] = True
                     shared_state['wall_side'] = 'right'
                 else:
                     shared_state['water_detected'] = False
                     shared_state['wall_side'] = None
             
-            old_gray = frame_gray.copy()                            
+            # 水に近づいている (滝と判定する前の、下向きに動き始めた軌跡がある) 間はオプティカルフローに
+            # 予算を回し、何もない通路では操舵に回す
+            if governor is not None:
+                falling_tracks = sum(tracker.count_falling(PRECURSOR_MIN_DY, TRAJECTORY_DRIFT_RATIO, TRAJECTORY_MIN_POINTS)
+                                     for tracker in trackers)
+                approaching_water = falling_tracks - len(candidate_end_points) >= PRECURSOR_MIN_TRACKS
+                governor.set_priority('optical_flow', 2.0 if approaching_water else 1.0)
+                governor.set_priority('vision', 0.5 if approaching_water else 1.5)
         except Exception as e:
             # print(f"[オプティカルフロー] エラー: {e}")
             pass 
         
+        if governor is not None:
+            INTERVAL = governor.finish('optical_flow', time.time() - process_start)
         elapsed = time.time() - loop_start_time
         wait_time = INTERVAL - elapsed
         if wait_time > 0:
@@ -385,13 +542,10 @@ def optical_flow_water_detection(shared_state, lock):
     print("[オプティカルフロー]: 終了しました。")
 
 # ===================================================================
-# 補助関数: 深度画像から距離を計算 (WallDetectorのロジックを移植)
+# 補助関数: 壁検出用ROI (WallDetectorのロジックを移植)
 # ===================================================================
-def calculate_distance_logic(depth_image, depth_scale, side):
-    if depth_image is None:
-        return None
-
-    H, W = depth_image.shape
+def wall_roi(H, W, side):
+    """RGB画像上の壁ROIを (y1, y2, x1, x2) で返す (不正なsideは None)"""
     # ROIの定義 (画面の上下100px、幅30px)
     roi_h = 100
     roi_w = 30
@@ -405,7 +559,26 @@ def calculate_distance_logic(depth_image, depth_scale, side):
         roi_x1 = 0
         roi_x2 = roi_w
     else:
+        return None
+    return roi_y1, roi_y2, roi_x1, roi_x2
+
+# ===================================================================
+# 補助関数: 深度画像から距離を計算 (WallDetectorのロジックを移植)
+# ===================================================================
+def calculate_distance_logic(depth_image, depth_scale, side, roi=None):
+    """
+    roi (y1, y2, x1, x2) を渡した場合はそれを使う (位置合わせ前の深度画像用)。
+    省略時はRGBに位置合わせ済みの深度画像として wall_roi() を使う。
+    """
+    if depth_image is None:
+        return None
+
+    H, W = depth_image.shape
+    if roi is None:
+        roi = wall_roi(H, W, side)
+    if roi is None:
         return 0.0
+    roi_y1, roi_y2, roi_x1, roi_x2 = roi
 
     # ROI抽出と計算
     if roi_y1 < 0 or roi_y2 > H or roi_x1 < 0 or roi_x2 > W:
@@ -426,9 +599,12 @@ def wall_control_thread(shared_state, lock, ser, wall_side):
     
     #壁接近用の定数の定義
     TARGET_DISTANCE = 0.75  # 目標とする壁との距離 (0.75m)
-    CONTROL_FPS = 15
+    CONTROL_FPS = 15          # ガバナー使用時は基準値
+    MIN_FPS, MAX_FPS = 8, 20
     CONTROL_INTERVAL = 1.0 / CONTROL_FPS
     ERROR_THRESHOLD = 0.1   
+    MAX_DEPTH_AGE = 0.3     # これより古いDepthでは操作しない -> 'S'
+    HALT_DEPTH_AGE = 1.0    # これより古い(カメラ停止など) -> 'H'
     
     # ターゲットの決定
     target_wall_side = None
@@ -446,14 +622,21 @@ def wall_control_thread(shared_state, lock, ser, wall_side):
     with lock:
         shared_state['stop_wall_control'] = False 
     
+    frames_exchange = shared_state['frames']
+    
+    governor = shared_state.get('governor')
+    if governor is not None:
+        governor.add_stage('wall_control', CONTROL_FPS, MIN_FPS, MAX_FPS)
+    
     while True:
         with lock:
             if shared_state['stop'] or shared_state['stop_wall_control']:
                 break
-            
-            # ★修正: 共有メモリからDepth画像とScaleを取得
-            depth_img = shared_state.get('latest_depth')
-            scale = shared_state.get('depth_scale', 0.001)
+        
+        # ★修正: フレーム交換器からDepth画像とScaleを取得 (グローバルロック不要)
+        packet = frames_exchange.latest()
+        depth_img = packet.depth if packet is not None else None
+        scale = frames_exchange.depth_scale
         
         loop_start = time.time()
         
@@ -463,11 +646,23 @@ def wall_control_thread(shared_state, lock, ser, wall_side):
             continue
             
         # 1. 距離計算 (関数呼び出し)
-        current_distance = calculate_distance_logic(depth_img, scale, target_wall_side)
+        # 深度画像は位置合わせしていないので、起動時に変換したROIを使う
+        depth_roi = None
+        if frames_exchange.depth_rois:
+            depth_roi = frames_exchange.depth_rois.get(target_wall_side)
+        current_distance = calculate_distance_logic(depth_img, scale, target_wall_side, depth_roi)
+        if not frames_exchange.is_intact(packet):
+            # 計算中に深度画像が上書きされた -> 最新のフレームで計算し直す
+            continue
+        wall_meta = make_result_meta(packet)
         
         # 2. コマンド生成
         command = "" 
-        if current_distance == 0.0:
+        safe_command = stale_result_command(wall_meta, MAX_DEPTH_AGE, HALT_DEPTH_AGE)
+        if safe_command is not None:
+            command = f"{safe_command}\n"
+            print(f" [CONTROL] Depthが古い ({(time.time() - packet.capture_time) * 1000:.0f}ms) -> '{safe_command}'")
+        elif current_distance == 0.0:
             command = "N\n" 
             print(" [CONTROL] 壁検出不能(0.0m) -> 'N'")
         else:
@@ -494,11 +689,162 @@ def wall_control_thread(shared_state, lock, ser, wall_side):
             except serial.SerialException as e:
                 print(f"[壁制御] Serial Error: {e}")
         
-        print(f"\r [壁制御] {target_wall_side}壁追従: {current_distance:.2f}m, Cmd: {command.strip()}", end="")
+        print(f"\r [壁制御] {target_wall_side}壁追従: {current_distance:.2f}m, Cmd: {command.strip()}, "
+              f"{format_latency(wall_meta, time.time())}", end="")
 
         elapsed = time.time() - loop_start
+        if governor is not None:
+            CONTROL_INTERVAL = governor.finish('wall_control', elapsed)
         wait_time = CONTROL_INTERVAL - elapsed
         if wait_time > 0:
             time.sleep(wait_time)
+    
+    if governor is not None:
+        governor.remove_stage('wall_control')
 
-    print("\n[壁制御]: 終了しました。")
\ No newline at end of file
+    print("\n[壁制御]: 終了しました。")
+
+# ===================================================================
+# スレッド6: セッション録画スレッド (オフライン調整用のフィールドデータ収集)
+# ===================================================================
+def session_recorder_thread(shared_state, lock, recorder):
+    """
+    公開された全フレームを、その時点の判断結果 (操舵・水検知・壁) と一緒に録画する。
+    カメラ取得スレッドとは別スレッドで動くので、書き込みが遅くても取得は止まらない。
+    (録画が追いつかず飛ばしたフレームは recorder.dropped に数える)
+    """
+    FRAME_WAIT_TIMEOUT = 0.1
+    
+    frames_exchange = shared_state['frames']
+    last_seq = 0
+    started = False
+    
+    while True:
+        with lock:
+            if shared_state['stop']:
+                break
+        
+        packet = frames_exchange.wait_for_frame(last_seq, timeout=FRAME_WAIT_TIMEOUT)
+        if packet is None:
+            continue
+        
+        if not started:
+            # カメラ起動後の情報 (スケール・ROI) でメタデータを書く
+            height, width = packet.color.shape[:2]
+            recorder.start(frames_exchange.depth_scale, frames_exchange.depth_rois, width, height,
+                           frames_exchange.depth_column_map)
+            started = True
+        elif packet.seq > last_seq + 1:
+            recorder.dropped += packet.seq - last_seq - 1
+        last_seq = packet.seq
+        
+        with lock:
+            decisions = {
+                'mode': shared_state.get('mode'),
+                'steering_value': shared_state.get('steering_value'),
+                'steering_success': shared_state.get('steering_success'),
+                'steering_confidence': shared_state.get('steering_confidence'),
+                'gravity_value': shared_state.get('gravity_value'),
+                'gravity_confidence': shared_state.get('gravity_confidence'),
+                'corridor_value': shared_state.get('corridor_value'),
+                'corridor_confidence': shared_state.get('corridor_confidence'),
+                'water_detected': shared_state.get('water_detected'),
+                'wall_side': shared_state.get('wall_side'),
+                'steering_meta': shared_state.get('steering_meta'),
+                'water_meta': shared_state.get('water_meta'),
+            }
+        recorder.record(packet.color, packet.depth, packet.timestamp, packet.frame_number, decisions,
+                        is_intact=lambda: frames_exchange.is_intact(packet))
+    
+    recorder.stop()
+    print("[録画スレッド]: 終了しました。")
+
+# ===================================================================
+# プロセス版ランタイム用: ワーカープロセス内の shared_state
+# ===================================================================
+class _FlushingLock:
+    """with を抜ける時に、ブロック内で書いた結果をまとめて親プロセスへ送るロック"""
+    def __init__(self, state):
+        self._lock = threading.Lock()
+        self._state = state
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._state.flush()
+        finally:
+            self._lock.release()
+
+
+class ProcessSharedState(dict):
+    """
+    スレッド関数をそのままワーカープロセスで動かすための shared_state。
+    - 'stop' は親プロセスの停止イベントを読む
+    - remote_values のキーは親プロセスと共有する multiprocessing.Value を読む
+    - 書き込まれた結果は lock を抜けた時点で結果キューへ1メッセージとして送る
+    """
+    def __init__(self, initial, stop_event, result_queue, remote_values=None):
+        super().__init__(initial)
+        self._stop_event = stop_event
+        self._result_queue = result_queue
+        self._remote_values = remote_values or {}
+        self._pending = {}
+        self.lock = _FlushingLock(self)
+
+    def __getitem__(self, key):
+        if key == 'stop':
+            return self._stop_event.is_set()
+        if key in self._remote_values:
+            return bool(self._remote_values[key].value)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key == 'stop' or key in self._remote_values:
+            return self[key]
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._pending[key] = value
+
+    def flush(self):
+        if self._pending:
+            self._result_queue.put(self._pending)
+            self._pending = {}
+
+
+def worker_process_main(target, frames, stop_event, result_queue, remote_values=None, args=()):
+    """
+    ワーカープロセスのエントリーポイント。
+    target はスレッド関数 (realsense_capture_thread / vision_processing_thread /
+    optical_flow_water_detection) で、(shared_state, lock, *args) で呼び出す。
+    """
+    state = ProcessSharedState({'frames': frames}, stop_event, result_queue, remote_values)
+    try:
+        target(state, state.lock, *args)
+    except KeyboardInterrupt:
+        pass  # 終了処理は親プロセスが行う
+
+
+def result_collector_thread(shared_state, lock, result_queue, remote_values=None):
+    """ワーカープロセスから届いた結果を親プロセスの shared_state へ反映するスレッド"""
+    remote_values = remote_values or {}
+    while True:
+        try:
+            update = result_queue.get(timeout=0.1)
+        except queue.Empty:
+            with lock:
+                if shared_state['stop']:
+                    break
+            continue
+
+        with lock:
+            shared_state.update(update)
+        # ワーカー同士で参照する値 (例: 水検知中は操舵を止める) を共有値へ反映
+        for key, value in update.items():
+            if key in remote_values:
+                remote_values[key].value = int(bool(value))
+    print("[結果受信スレッド]: 終了しました。")
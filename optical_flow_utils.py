@@ -0,0 +1,249 @@
+#
+# ファイル名: optical_flow_utils.py
+# 役割: オプティカルフローによる水(滝)検出の共通処理
+#       function1120.py の optical_flow_water_detection と sparse_optical_trajectory2*.py から使う
+#
+
+import cv2
+import numpy as np
+
+
+class TrackStore:
+    """
+    特徴点の軌跡をまとめて配列で持つストア (Pythonのリストの代わり)。
+    - points: (capacity, max_len, 2) float32 のリングバッファ。軌跡 i の最新点は points[i, head[i]]
+    - length: 軌跡ごとの点数 (max_len で頭打ち、古い点から上書きされる)
+    - last:   軌跡ごとの最新点 (capacity, 2)。latest_points() はこれのビュー (コピーなし)
+    生きている軌跡は常に先頭 count 個に詰めて置く。
+    """
+    def __init__(self, capacity, max_len):
+        self.capacity = capacity
+        self.max_len = max_len
+        self.points = np.zeros((capacity, max_len, 2), np.float32)
+        self.head = np.zeros(capacity, np.int32)
+        self.length = np.zeros(capacity, np.int32)
+        self.last = np.zeros((capacity, 2), np.float32)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def latest_points(self):
+        """calcOpticalFlowPyrLK に渡す p0 ((count, 1, 2) float32、内部配列のビュー)"""
+        return self.last[:self.count].reshape(-1, 1, 2)
+
+    def advance(self, new_points, keep):
+        """
+        追跡結果で全軌跡を1点進める。
+        new_points: latest_points() と同じ順の新しい点 ((count, 1, 2) など)
+        keep: 残す軌跡の真偽配列 (False の軌跡は削除して詰める)
+        """
+        kept = np.flatnonzero(np.asarray(keep).ravel()[:self.count])
+        n = kept.size
+        new_points = np.asarray(new_points, np.float32).reshape(-1, 2)[kept]
+        self._compact(kept)
+
+        rows = np.arange(n)
+        self.head[:n] = (self.head[:n] + 1) % self.max_len
+        self.points[rows, self.head[:n]] = new_points
+        np.minimum(self.length[:n] + 1, self.max_len, out=self.length[:n])
+        self.last[:n] = new_points
+
+    def _compact(self, kept):
+        """kept (昇順のインデックス) の軌跡だけを先頭へ詰める (最初に位置がずれる所から後ろだけ動かす)"""
+        n = kept.size
+        moved = np.flatnonzero(kept != np.arange(n))
+        if moved.size > 0:
+            start = moved[0]
+            src = kept[start:]
+            self.points[start:n] = self.points[src]
+            self.head[start:n] = self.head[src]
+            self.length[start:n] = self.length[src]
+            self.last[start:n] = self.last[src]
+        self.count = n
+
+    def add(self, new_points):
+        """
+        新しい軌跡 (1点だけ) を追加する。
+        容量が足りない時は新しい点ではなく、動きの最も小さい既存の軌跡 (同じなら長く続いている方) を捨てて空ける。
+        (静止した壁の角などの軌跡で埋まって、新しく現れた滝の点を追えなくなるのを防ぐ)
+        """
+        if new_points is None:
+            return
+        new_points = np.asarray(new_points, np.float32).reshape(-1, 2)[:self.capacity]
+        overflow = self.count + len(new_points) - self.capacity
+        if overflow > 0:
+            movement = np.abs(self.end_points() - self.start_points()).sum(axis=1)
+            order = np.lexsort((-self.length[:self.count], movement))
+            keep = np.ones(self.count, bool)
+            keep[order[:overflow]] = False
+            self._compact(np.flatnonzero(keep))
+        start, end = self.count, self.count + len(new_points)
+        self.points[start:end, 0] = new_points
+        self.head[start:end] = 0
+        self.length[start:end] = 1
+        self.last[start:end] = new_points
+        self.count = end
+
+    def _oldest_index(self):
+        return (self.head[:self.count] - self.length[:self.count] + 1) % self.max_len
+
+    def start_points(self):
+        """各軌跡の最も古い点 (count, 2)"""
+        return self.points[np.arange(self.count), self._oldest_index()]
+
+    def end_points(self):
+        """各軌跡の最新点 (count, 2)"""
+        return self.last[:self.count]
+
+    def mid_points(self):
+        """各軌跡の中間点 (古い方から数えて length // 2 番目) (count, 2)"""
+        index = (self._oldest_index() + self.length[:self.count] // 2) % self.max_len
+        return self.points[np.arange(self.count), index]
+
+    def track(self, i):
+        """軌跡 i を古い順に並べた (length, 2) 配列 (描画用)"""
+        index = (self.head[i] - self.length[i] + 1 + np.arange(self.length[i])) % self.max_len
+        return self.points[i, index]
+
+
+def classify_trajectories(starts, ends, lengths, min_dy, drift_ratio, min_points):
+    """
+    全軌跡をまとめて判定し、滝 (ほぼ真下へ落ちる動き) らしい軌跡の真偽配列を返す。
+    - 点数が min_points 以上
+    - 最初の点から最新点までの下向きの移動量 dy が min_dy 以上
+    - 横ずれの比 |dx| / dy が drift_ratio 以下
+    """
+    dx = ends[:, 0] - starts[:, 0]
+    dy = ends[:, 1] - starts[:, 1]
+    falling = (lengths >= min_points) & (dy >= min_dy) & (dy != 0)
+    ratio = np.divide(np.abs(dx), dy, out=np.full_like(dy, np.inf), where=falling)
+    return falling & (ratio <= drift_ratio)
+
+
+class WaterfallGrid:
+    """
+    滝の検出位置をセル単位で覚えておく TTL グリッド (ちらつき防止のメモリ)。
+    ttl[cell_y, cell_x] が 0 より大きいセルが「記憶中の滝」。セル数は画像サイズで決まり、
+    検出をいくつ覚えていても1フレームの処理量は変わらない。
+    画像の外の点は端のセルに入れる。
+    """
+    def __init__(self, width, height, cell_size, ttl):
+        self.cell_size = cell_size
+        self.max_ttl = ttl
+        self.grid_w = int(np.ceil(width / cell_size))
+        self.grid_h = int(np.ceil(height / cell_size))
+        self.ttl = np.zeros((self.grid_h, self.grid_w), np.int16)
+
+    def update(self, points, min_count=1):
+        """
+        全セルの TTL を1減らし、今回 points ((N, 2) の x, y) が min_count 点以上入ったセルを最大値に戻す。
+        今回の「熱い」セルの真偽グリッドを返す。
+        """
+        self.ttl -= self.ttl > 0
+
+        points = np.asarray(points).reshape(-1, 2)
+        cell_x = np.clip(points[:, 0] // self.cell_size, 0, self.grid_w - 1).astype(np.intp)
+        cell_y = np.clip(points[:, 1] // self.cell_size, 0, self.grid_h - 1).astype(np.intp)
+        counts = np.bincount(cell_y * self.grid_w + cell_x, minlength=self.grid_h * self.grid_w)
+        hot = (counts >= min_count).reshape(self.grid_h, self.grid_w)
+        self.ttl[hot] = self.max_ttl
+        return hot
+
+    def any_active(self):
+        return bool(self.ttl.any())
+
+    def active_in_columns(self, x_start, x_end):
+        """x が [x_start, x_end) の範囲にかかるセルに記憶中の滝があるか"""
+        col_start = max(0, int(x_start) // self.cell_size)
+        col_end = min(self.grid_w, -(-int(x_end) // self.cell_size))
+        return bool(self.ttl[:, col_start:col_end].any())
+
+    def active_cells(self):
+        """記憶中のセルの (cell_y, cell_x, 残りTTL) の一覧 (描画・表示用)"""
+        return [(int(y), int(x), int(self.ttl[y, x])) for y, x in np.argwhere(self.ttl > 0)]
+
+
+def crop_resize_strip(gray, x_start, x_end, resize_width):
+    """
+    元解像度の gray を幅 resize_width に縮小した画像の x が [x_start, x_end) の部分を、
+    その帯だけを切り出して縮小することで作る (INTER_AREA)。
+    x_start * 元の幅 / resize_width が整数になる位置で切れば、全体を縮小してから切り出した画像と一致する。
+    """
+    orig_height, orig_width = gray.shape[:2]
+    scale = orig_width / resize_width
+    resize_height = int(resize_width * (orig_height / orig_width))
+    strip = gray[:, int(round(x_start * scale)):int(round(x_end * scale))]
+    return cv2.resize(strip, (x_end - x_start, resize_height), interpolation=cv2.INTER_AREA)
+
+
+class BandFlowTracker:
+    """
+    画像の1つの帯 (全体画像での x が x_offset から始まる) の特徴点を LK で追跡し、軌跡を TrackStore に貯める。
+    左右の帯をそれぞれ独立したトラッカーで追う (全体画像を1つで追う場合は x_offset=0)。
+    - drop_range: (x0, x1) 全体画像の座標。追跡後に x0 < x < x1 へ入った軌跡は削除する (中央帯)
+    - detect_ranges: [(x0, x1), ...] 全体画像の座標。新しい特徴点はこの範囲 (x1 は含まない) で探す
+    軌跡は帯の座標で持ち、滝らしい軌跡の点は全体画像の座標に直して返す。
+    """
+    def __init__(self, capacity, max_len, min_tracks, lk_params, feature_params,
+                 drop_range, detect_ranges, x_offset=0):
+        self.tracks = TrackStore(capacity, max_len)
+        self.min_tracks = min_tracks
+        self.lk_params = lk_params
+        self.feature_params = feature_params
+        self.drop_range = drop_range
+        self.detect_ranges = detect_ranges
+        self.x_offset = x_offset
+        self.old_gray = None
+        self._detection_mask = None
+
+    def _mask_for(self, shape):
+        """特徴点探索のマスク (画像サイズが変わった時だけ作り直す)"""
+        if self._detection_mask is None or self._detection_mask.shape != shape:
+            self._detection_mask = np.zeros(shape, dtype=np.uint8)
+            for x_start, x_end in self.detect_ranges:
+                x_start = max(0, x_start - self.x_offset)
+                x_end = max(0, x_end - self.x_offset)
+                self._detection_mask[:, x_start:x_end] = 255
+        return self._detection_mask
+
+    def step(self, gray, redetect=False):
+        """
+        新しいフレームで全軌跡を1点進め、必要なら特徴点を補充する。
+        最初のフレームは前フレームとして覚えるだけ。
+        """
+        if self.old_gray is None:
+            self.old_gray = gray
+            return
+
+        if len(self.tracks) > 0:
+            p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, gray, self.tracks.latest_points(), None, **self.lk_params)
+            new_x = p1[:, 0, 0] + self.x_offset
+            drop_start, drop_end = self.drop_range
+            keep = (st[:, 0] == 1) & ~((drop_start < new_x) & (new_x < drop_end))
+            self.tracks.advance(p1, keep)
+
+        if len(self.tracks) < self.min_tracks or redetect:
+            new_points = cv2.goodFeaturesToTrack(gray, mask=self._mask_for(gray.shape), **self.feature_params)
+            self.tracks.add(new_points)
+
+        # 渡される画像 (フレームの前処理キャッシュ・帯の縮小結果) は後から書き換えられないので、コピーせず参照だけ持つ
+        self.old_gray = gray
+
+    def count_falling(self, min_dy, drift_ratio, min_points):
+        """classify_trajectories の条件 (下向きの移動量 min_dy 以上) を満たす軌跡の数"""
+        tracks = self.tracks
+        return int(np.count_nonzero(classify_trajectories(
+            tracks.start_points(), tracks.end_points(), tracks.length[:len(tracks)],
+            min_dy, drift_ratio, min_points)))
+
+    def candidate_points(self, min_dy, drift_ratio, min_points):
+        """滝らしい軌跡 (classify_trajectories) の最新点を全体画像の座標で返す (N, 2)"""
+        tracks = self.tracks
+        is_candidate = classify_trajectories(
+            tracks.start_points(), tracks.end_points(), tracks.length[:len(tracks)],
+            min_dy, drift_ratio, min_points)
+        points = tracks.end_points()[is_candidate]
+        if self.x_offset:
+            points = points + np.float32([self.x_offset, 0])
+        return points
@@ -2,34 +2,79 @@
 import serial
 import time
 import threading
+import multiprocessing
 
 #関数のインポート (realsense_capture_thread に変更)
-from function1117 import realsense_capture_thread, vision_processing_thread, optical_flow_water_detection, wall_control_thread
+from function1120 import realsense_capture_thread, vision_processing_thread, optical_flow_water_detection, wall_control_thread
+from function1120 import worker_process_main, result_collector_thread, session_recorder_thread
+from function1120 import format_latency, stale_result_command, RateGovernor, RESIZE_WIDTH
+from frame_exchange import FrameExchange, SharedFrameRing
+from frame_source import RecordedSource, SessionRecorder
+from vision_utils import SteeringTracker, SteeringFusion
 
 #定数の定義
 STEERING_THRESHOLD = 2 
+# 操舵結果の鮮度 (元フレームの取得からの経過時間)。古い結果で曲がり続けないようにする
+STEERING_MAX_AGE_SEC = 0.6    # これより古ければ 'S' (直進)
+STEERING_HALT_AGE_SEC = 1.5   # これより古い・結果が無ければ 'H' (停止)
+# True: 操舵値をカルマンフィルタで追跡し、制御ループの周期ごとに現在時刻の推定値を使う
+USE_STEERING_TRACKER = False
+GRAVITY_CONFIDENCE = 0.2      # 重心フォールバックの結果をトラッカーに入れる時の信頼度
+# True: 消失点・重心・深度の通路中心を信頼度で重み付けして1つの操舵量にまとめる (制御ループの周期で実行)
+USE_STEERING_FUSION = False
 MAIN_LOOP_WAIT_MS = 50 
 MAIN_LOOP_WAIT_SEC = MAIN_LOOP_WAIT_MS / 1000.0 
 SERIAL_PORT = '/dev/ttyS0' 
 SERIAL_BAUDRATE = 115200
 
+# True: カメラ取得・操舵・水検知を別プロセスで動かす (GILを避けて4コアを使う)
+USE_PROCESSES = False
+FRAME_WIDTH = 640   # realsense_capture_thread の解像度と合わせる
+FRAME_HEIGHT = 480
+
+# True: 各スレッドの実行レートを処理時間に応じて自動調整する (スレッド版のみ)
+USE_RATE_GOVERNOR = True
+GOVERNOR_CPU_BUDGET = 0.8  # 全スレッドの処理に使ってよいCPU時間 (1.0 = 1コア分)
+
+# 録画セッションのディレクトリを指定すると、RealSenseの代わりに再生する (実機なしでの検証用)
+REPLAY_SESSION_PATH = None
+REPLAY_REALTIME = True   # False: 録画を最速で再生 (ベンチマーク・プロファイル用)
+
+# 録画先のディレクトリを指定すると、フレームと判断結果を記録する (オフライン調整用)
+RECORD_SESSION_PATH = None
+RECORD_EVERY_N = 1       # 2なら2フレームに1枚だけ記録
+
 #メイン処理
 def main():
+    # RGB+Depth画像の受け渡し (スレッド版: トリプルバッファ / プロセス版: 共有メモリのリング)
+    if USE_PROCESSES:
+        frames = SharedFrameRing((FRAME_HEIGHT, FRAME_WIDTH, 3), (FRAME_HEIGHT, FRAME_WIDTH))
+    else:
+        # グレースケール化はカメラスレッドで1回だけ行い、縮小は各スレッドの要求時に共有
+        frames = FrameExchange(warm=('gray',))
+    
     #共有変数の初期化
     shared_state ={
-        'latest_frame': None,    # RGB画像 (Numpy)
-        'latest_depth': None,    # Depth画像 (Numpy) ★追加
-        'depth_scale': 0.001,    # 深度スケール ★追加
-        'prev_frame': None,      # 一つ前のRGB
-        'new_frame_flag': False, 
+        'frames': frames,
         'steering_value': 0.0, 
         'steering_success': False, 
+        'steering_confidence': 0.0,  # 消失点の信頼度 (0.0〜1.0, 重心フォールバック時は 0.0)
+        'steering_meta': None,   # 操舵結果の元フレーム情報 (フレーム番号・取得/判断時刻)
+        'gravity_value': 0.0,        # 暗さの重心のズレ (毎フレーム計算、遠/中/近の帯を合成)
+        'gravity_confidence': 0.0,
+        'gravity_bands': None,       # 帯ごとのズレ {'far': .., 'mid': .., 'near': ..}
+        'corridor_value': None,      # 深度画像から求めた通路中心のズレ (求まらなければ None)
+        'corridor_confidence': 0.0,
         'water_detected': False, 
         'wall_side': None, 
+        'water_meta': None,      # 水検知結果の元フレーム情報
         'stop': False, 
         'stop_wall_control': False, 
         'mode': 'DRIVING' 
     }
+    if USE_RATE_GOVERNOR and not USE_PROCESSES:
+        # プロセス版は各段が別コアで動くため、固定レートのまま使う
+        shared_state['governor'] = RateGovernor(cpu_budget=GOVERNOR_CPU_BUDGET)
 
     lock = threading.Lock()
 
@@ -40,27 +85,67 @@ def main():
         print(f"[メイン]: シリアルポート ({SERIAL_PORT}) を開きました。")
     except serial.SerialException as e:
         print(f"[メイン] エラー: シリアルポート ({SERIAL_PORT}) を開けません。{e}")
-        return
+        if REPLAY_SESSION_PATH is None:
+            if USE_PROCESSES:
+                frames.close()
+            return
+        print("[メイン]: 録画再生中のため、シリアル出力なしで続行します。")
+
+    # フレームソース (None: 実機のRealSense)
+    camera_args = ()
+    if REPLAY_SESSION_PATH is not None:
+        camera_args = (RecordedSource(REPLAY_SESSION_PATH, realtime=REPLAY_REALTIME),)
 
-    # ★変更: RealSense統合スレッドの準備
-    # camera_index は不要になったため引数から削除
-    t_camera = threading.Thread(target=realsense_capture_thread, args=(shared_state, lock))
+    t_collector = None
+    if USE_PROCESSES:
+        # 各ワーカーは結果だけを小さなメッセージでメインへ送り返す
+        stop_event = multiprocessing.Event()
+        result_queue = multiprocessing.Queue()
+        # 操舵プロセスが参照する水検知フラグ
+        remote_values = {'water_detected': multiprocessing.Value('b', 0)}
+        
+        t_camera = multiprocessing.Process(target=worker_process_main, args=(realsense_capture_thread, frames, stop_event, result_queue, None, camera_args))
+        t_vision = multiprocessing.Process(target=worker_process_main, args=(vision_processing_thread, frames, stop_event, result_queue, remote_values))
+        t_optical = multiprocessing.Process(target=worker_process_main, args=(optical_flow_water_detection, frames, stop_event, result_queue))
+        t_collector = threading.Thread(target=result_collector_thread, args=(shared_state, lock, result_queue, remote_values))
+    else:
+        # ★変更: RealSense統合スレッドの準備
+        # camera_index は不要になったため引数から削除
+        t_camera = threading.Thread(target=realsense_capture_thread, args=(shared_state, lock) + camera_args)
 
-    #画像処理スレッドの開始
-    t_vision = threading.Thread(target=vision_processing_thread, args=(shared_state, lock))
+        #画像処理スレッドの開始
+        t_vision = threading.Thread(target=vision_processing_thread, args=(shared_state, lock))
+        
+        #オプティカルフロースレッドの開始
+        t_optical = threading.Thread(target=optical_flow_water_detection, args=(shared_state, lock))
     
-    #オプティカルフロースレッドの開始
-    t_optical = threading.Thread(target=optical_flow_water_detection, args=(shared_state, lock))
+    #録画スレッド (録画先が指定された時のみ)
+    t_recorder = None
+    if RECORD_SESSION_PATH is not None:
+        recorder = SessionRecorder(RECORD_SESSION_PATH, every_n=RECORD_EVERY_N)
+        t_recorder = threading.Thread(target=session_recorder_thread, args=(shared_state, lock, recorder))
     
     #壁追従スレッド (ここではまだ生成しない)
     t_wall_control = None
     
+    # 操舵値のトラッカー (新しい結果が届いた時だけ観測として取り込む)
+    steering_tracker = SteeringTracker() if USE_STEERING_TRACKER else None
+    last_steering_decision = None
+    # 操舵量の統合 (入力はすべて操舵用画像の px 単位なので、その半幅で正規化する)
+    steering_fusion = SteeringFusion(RESIZE_WIDTH / 2) if USE_STEERING_FUSION else None
+    
     print("[メイン]: RealSense統合スレッドを起動します...")
     t_camera.start()
     print("[メイン]: 画像処理スレッド（操舵＋重心）を起動します...")
     t_vision.start()
     print("[メイン]: オプティカルフロースレッドを起動します...")
     t_optical.start()
+    if t_collector is not None:
+        print("[メイン]: 結果受信スレッドを起動します...")
+        t_collector.start()
+    if t_recorder is not None:
+        print("[メイン]: 録画スレッドを起動します...")
+        t_recorder.start()
 
     try:
         while True:
@@ -73,14 +158,20 @@ def main():
                 current_mode = shared_state['mode'] 
                 is_water_detected = shared_state['water_detected'] 
                 detected_wall_side = shared_state['wall_side'] 
+                water_meta = shared_state['water_meta']
                 
             # --- モード切替ロジック ---
             if is_water_detected and current_mode == 'DRIVING':
-                print(f"\n[メイン] モード変更: DRIVING -> WALL_FOLLOWING (水検出: {detected_wall_side})")
+                print(f"\n[メイン] モード変更: DRIVING -> WALL_FOLLOWING (水検出: {detected_wall_side}, "
+                      f"{format_latency(water_meta, time.time())})")
                 
                 with lock:
                     shared_state['mode'] = 'WALL_FOLLOWING'
                     shared_state['stop_wall_control'] = False
+                if steering_tracker is not None:
+                    steering_tracker.reset()  # 壁追従の後は追跡をやり直す
+                if steering_fusion is not None:
+                    steering_fusion.reset()
                     
                 # 壁制御スレッドを起動
                 t_wall_control = threading.Thread(target=wall_control_thread, args=(shared_state, lock, ser, detected_wall_side))
@@ -103,6 +194,12 @@ def main():
                 with lock:
                     current_steering_diff = shared_state['steering_value']
                     is_steering_success = shared_state['steering_success']
+                    steering_confidence = shared_state['steering_confidence']
+                    steering_meta = shared_state['steering_meta']
+                    gravity_value = shared_state['gravity_value']
+                    gravity_confidence = shared_state['gravity_confidence']
+                    corridor_value = shared_state['corridor_value']
+                    corridor_confidence = shared_state['corridor_confidence']
                 
                 if is_steering_success:  
                     active_steering_diff = current_steering_diff
@@ -111,12 +208,42 @@ def main():
                     active_steering_diff = current_steering_diff
                     mode_text = "Fallback (GRAVITY)"
                 
+                # 新しい結果をトラッカーへ入れ、現在時刻の推定値で操舵する
+                if steering_tracker is not None and steering_meta:
+                    if steering_meta['decision_time'] != last_steering_decision:
+                        last_steering_decision = steering_meta['decision_time']
+                        # 統合する場合は重心を別の入力として扱うので、トラッカーには消失点だけを入れる
+                        if is_steering_success or steering_fusion is None:
+                            confidence = steering_confidence if is_steering_success else GRAVITY_CONFIDENCE
+                            steering_tracker.update(current_steering_diff, confidence, steering_meta['capture_time'])
+                    predicted_steering_diff = steering_tracker.predict(time.time())
+                    if predicted_steering_diff is not None:
+                        active_steering_diff = predicted_steering_diff
+                
+                # 消失点・重心・通路中心を1つの操舵量にまとめる (入力の切り替わりで跳ねないように平滑化)
+                if steering_fusion is not None and steering_meta:
+                    fused_steering_diff = steering_fusion.update({
+                        'vp': (active_steering_diff if is_steering_success else None, steering_confidence),
+                        'gravity': (gravity_value, gravity_confidence),
+                        'corridor': (corridor_value, corridor_confidence),
+                    }, time.time())
+                    if fused_steering_diff is not None:
+                        active_steering_diff = fused_steering_diff
+                        weights = steering_fusion.effective_weights
+                        mode_text = f"FUSION v{weights['vp']:.1f} g{weights['gravity']:.1f} c{weights['corridor']:.1f}"
+                
                 steering_command = "S"
                 if abs(active_steering_diff) > STEERING_THRESHOLD:
                     if active_steering_diff > 0:
                         steering_command = f"R {active_steering_diff:.2f}" 
                     else:
                         steering_command = f"L {abs(active_steering_diff):.2f}"
+                
+                # 結果が古すぎる場合は安全側のコマンドに落とす
+                safe_command = stale_result_command(steering_meta, STEERING_MAX_AGE_SEC, STEERING_HALT_AGE_SEC)
+                if safe_command is not None:
+                    steering_command = safe_command
+                    mode_text = "STALE"
                     
                 final_command = steering_command
 
@@ -128,10 +255,13 @@ def main():
                         print(f"[メイン] エラー: シリアル書き込み失敗。{e}")
                         ser.close()
                         ser = None
+                write_time = time.time()
                 
                 print(f"\r状態: DRIVING, Mode: {mode_text:<18}, "
                     f"ズレ: {active_steering_diff:6.2f}, " 
-                    f"コマンド: {final_command:<10}", end="")
+                    f"信頼度: {steering_confidence:4.2f}, "
+                    f"コマンド: {final_command:<10}, "
+                    f"{format_latency(steering_meta, write_time)}", end="")
             
             # --- 走行ロジック (WALL_FOLLOWING) ---
             elif current_mode == 'WALL_FOLLOWING':
@@ -157,12 +287,23 @@ def main():
         with lock:
             shared_state['stop'] = True
             shared_state['stop_wall_control'] = True 
+        if USE_PROCESSES:
+            stop_event.set()
         
         if t_wall_control is not None and t_wall_control.is_alive():
             t_wall_control.join()
         t_optical.join()
         t_vision.join()
         t_camera.join()
+        if t_collector is not None:
+            t_collector.join()
+        if t_recorder is not None:
+            t_recorder.join()
+        if USE_PROCESSES:
+            frames.close()
+        
+        if shared_state.get('governor') is not None:
+            print(f"[メイン]: 実行レート: {shared_state['governor'].summary()}")
         
         if ser and ser.is_open:
             ser.close() 
@@ -6,6 +6,8 @@ import numpy as np
 import math
 import time
 
+from vision_utils import estimate_vanishing_point, remove_small_components
+
 # --- パラメータ (軽量化のため調整) ---
 RESIZE_WIDTH = 240
 MIN_NOISE_AREA = 45 
@@ -75,11 +77,8 @@ def steering_thread_func(camera_index, shared_state, lock):
                 edges = cv2.Canny(blurred_again, CANNY_THRESHOLD1, CANNY_THRESHOLD2)
                 
                 # --- 3. ノイズ除去 ---
-                num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(edges, connectivity=8)
-                cleaned_edges = np.zeros_like(edges)
-                for i in range(1, num_labels):
-                    if stats[i, cv2.CC_STAT_AREA] > MIN_NOISE_AREA:
-                        cleaned_edges[labels == i] = 255
+                # 小さな連結成分 (ノイズ) を除去 (ラベル -> 0/255 の変換表で1回で処理)
+                cleaned_edges = remove_small_components(edges, MIN_NOISE_AREA)
                 
                 # --- 4. ハフ変換 & 消失点計算 ---
                 lines = cv2.HoughLinesP(cleaned_edges, 1, np.pi/180,
@@ -87,57 +86,12 @@ def steering_thread_func(camera_index, shared_state, lock):
                                         minLineLength=HOUGH_MIN_LINE_LENGTH,
                                         maxLineGap=HOUGH_MAX_LINE_GAP)
                 
-                diagonal_lines = []
                 vp_x = width // 2
                 
-                if lines is not None:
-                    for line in lines:
-                        x1, y1, x2, y2 = line[0]
-                        angle_rad = math.atan2(y2 - y1, x2 - x1)
-                        angle_deg = math.degrees(angle_rad)
-                        abs_angle_deg = abs(angle_deg)
-
-                        is_horizontal = (abs_angle_deg <= 10) or (abs_angle_deg >= 175)
-                        is_vertical = (50 <= abs_angle_deg <= 130)
-                        if is_horizontal or is_vertical or x1 == x2:
-                            continue
-                        
-                        m = (y2 - y1) / (x2 - x1)
-                        c = y1 - m * x1
-                        diagonal_lines.append((m, c))
-
-                        # --- (描画処理 コメントアウト) ---
-                        # points = []
-                        # if m != 0:
-                        #     x_at_y0 = -c / m
-                        #     if 0 <= x_at_y0 <= width: points.append((int(x_at_y0), 0))
-                        #     x_at_y_height = (height - c) / m
-                        #     if 0 <= x_at_y_height <= width: points.append((int(x_at_y_height), height))
-                        # y_at_x0 = c
-                        # if 0 <= y_at_x0 <= height: points.append((0, int(y_at_x0)))
-                        # y_at_x_width = m * width + c
-                        # if 0 <= y_at_x_width <= height: points.append((width, int(y_at_x_width)))
-                    
-                        # if len(points) >= 2:
-                        #     cv2.line(resized_frame, points[0], points[1], (0, 255, 0), 2)
-                        # --- (描画処理 コメントアウトここまで) ---
-
-
-                intersection_points = []
-                if len(diagonal_lines) >= 2:
-                    for i in range(len(diagonal_lines)):
-                        for j in range(i + 1, len(diagonal_lines)):
-                            m1, c1 = diagonal_lines[i]
-                            m2, c2 = diagonal_lines[j]
-                            if abs(m1 - m2) < 1e-5 or m1*m2 >0 : continue
-                            x = (c2 - c1) / (m1 - m2)
-                            y = m1 * x + c1
-                            if -width < x < width * 2 and -height < y < height * 2:
-                                intersection_points.append((x, y))
-
-                if intersection_points:
-                    x_coords = [p[0] for p in intersection_points]
-                    vp_x = int(np.median(x_coords))
+                # 斜め線の抽出と交点計算 (ベクトル化版)
+                vanishing_point_x = estimate_vanishing_point(lines, width, height)
+                if vanishing_point_x is not None:
+                    vp_x = vanishing_point_x
 
                 # --- 5. ズレ量を計算 ---
                 image_center_x = width / 2
@@ -3,6 +3,8 @@ import numpy as np
 import os
 import sys
 
+from optical_flow_utils import TrackStore, classify_trajectories, WaterfallGrid
+
 # --- 1. パラメータ設定 (変更なし) ---
 # ... (VIDEO_FOLDER_PATH, PLAYBACK_SPEED_MS, RESIZE_WIDTH) ...
 VIDEO_FOLDER_PATH = "/Users/shigemitsuhiroki/vscode/sewage_movie/9_3_movie"
@@ -12,6 +14,7 @@ RESIZE_WIDTH = 480
 # --- 2. 軌跡追跡のパラメータ (変更なし) ---
 # ... (TRACK_MAX_LEN, RE_DETECT_INTERVAL, MIN_TRACKS, NEW_POINT_MIN_DIST) ...
 TRACK_MAX_LEN = 50
+TRACK_CAPACITY = 1000   # 同時に保持する軌跡の上限 (超える時は動きの最も小さい既存の軌跡を捨てて新規点を入れる)
 RE_DETECT_INTERVAL = 5
 MIN_TRACKS = 50
 NEW_POINT_MIN_DIST = 15
@@ -37,66 +40,6 @@ feature_params = dict(maxCorners=200, qualityLevel=0.01, minDistance=10, blockSi
 lk_params = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
 
 
-# --- analyze_trajectory 関数 (変更なし) ---
-def analyze_trajectory(track):
-    """
-    1本の軌跡(track)を分析し、滝かどうかを判定する
-    """
-    if len(track) < TRAJECTORY_MIN_POINTS:
-        return False
-    start_point = track[0]
-    end_point = track[-1]
-    start_x, start_y = start_point
-    end_x, end_y = end_point
-    dx = end_x - start_x
-    dy = end_y - start_y
-    if dy < TRAJECTORY_MIN_DY:
-        return False
-    if dy == 0:
-        return False
-    drift_ratio = abs(dx) / dy
-    if drift_ratio > TRAJECTORY_DRIFT_RATIO:
-        return False
-    return True
-
-
-# --- ★★★ 修正: find_clusters 関数 (戻り値を変更) ★★★ ---
-def find_clusters(candidate_tracks, grid_size, width, height, min_tracks):
-    """
-    滝候補の軌跡リストから、密集領域（ホットなグリッドセル）を見つける
-    
-    Returns:
-        set: (cell_y, cell_x) のタプルを含むセット
-             (例: {(10, 5), (10, 6)})
-    """
-    if not candidate_tracks:
-        return set() # 空のセットを返す
-
-    # 密集をカウントするためのグリッドを作成
-    grid_w = int(np.ceil(width / grid_size))
-    grid_h = int(np.ceil(height / grid_size))
-    grid_count = np.zeros((grid_h, grid_w), dtype=int)
-    
-    # 軌跡の中間点をグリッドにマッピングしてカウント
-    for track in candidate_tracks:
-        mid_point = track[len(track) // 2]
-        mid_x, mid_y = int(mid_point[0]), int(mid_point[1])
-        
-        grid_x = mid_x // grid_size
-        grid_y = mid_y // grid_size
-        
-        if 0 <= grid_y < grid_h and 0 <= grid_x < grid_w:
-            grid_count[grid_y, grid_x] += 1
-            
-    # しきい値(min_tracks)を超えたグリッド（「熱い」セル）を探す
-    hot_cells_np = np.argwhere(grid_count >= min_tracks)
-    
-    # (y, x) タプルのセットとして返す
-    hot_cells_set = set(tuple(cell) for cell in hot_cells_np)
-        
-    return hot_cells_set
-
-
 def main():
     # --- 1. 動画ファイルの選択 (省略... 元のコードと同じ) ---
     try:
@@ -149,12 +92,12 @@ def main():
         old_gray = cv2.cvtColor(resized_first_frame, cv2.COLOR_BGR2GRAY)
         
         # --- 軌跡追跡のロジック ---
-        active_tracks = [] 
+        active_tracks = TrackStore(TRACK_CAPACITY, TRACK_MAX_LEN)
         frame_idx = 0
         
         # --- ★★★ 追加: 滝検出の「メモリ」 ★★★ ---
-        # キー: (grid_y, grid_x), 値: TTL (Time-to-Live)
-        waterfall_memory = {}
+        # セル (grid_y, grid_x) ごとの TTL (Time-to-Live) を持つ固定サイズのグリッド
+        waterfall_memory = WaterfallGrid(RESIZE_WIDTH, resize_height, CLUSTER_GRID_CELL_SIZE, DETECTION_TTL)
         
         # --- 6. メインループ ---
         while True:
@@ -165,66 +108,42 @@ def main():
                 resized_frame = cv2.resize(frame, (RESIZE_WIDTH, resize_height), interpolation=cv2.INTER_AREA)
                 frame_gray = cv2.cvtColor(resized_frame, cv2.COLOR_BGR2GRAY)
                 mask = np.zeros_like(resized_frame)
-                new_tracks = []
                 
-                # --- 6a. 既存の軌跡を追跡 (変更なし) ---
-                if active_tracks:
-                    #なにやってるのか？
-                    p0 = np.float32([tr[-1] for tr in active_tracks]).reshape(-1, 1, 2)
+                # --- 6a. 既存の軌跡を追跡 ---
+                if len(active_tracks) > 0:
+                    # 各軌跡の最新点 (ストア内の配列のビュー) を追跡
+                    p0 = active_tracks.latest_points()
                     p1, st, err = cv2.calcOpticalFlowPyrLK(old_gray, frame_gray, p0, None, **lk_params)
-                    for i, (track, (new_point, status)) in enumerate(zip(active_tracks, zip(p1, st))):
-                        #status(追跡成功)が1のときのみ更新
-                        if status[0] == 0: continue
-                        new_point_tuple = tuple(new_point.ravel())
-                        track.append(new_point_tuple)
-                        if len(track) > TRACK_MAX_LEN: track.pop(0)
-                        new_tracks.append(track)
-                active_tracks = new_tracks
+                    #status(追跡成功)が1の軌跡のみ更新、それ以外は削除
+                    active_tracks.advance(p1, st[:, 0] == 1)
 
-                # --- 6b. 新しい特徴点を検出・追加 (変更なし) ---
+                # --- 6b. 新しい特徴点を検出・追加 ---
                 if len(active_tracks) < MIN_TRACKS or frame_idx % RE_DETECT_INTERVAL == 0:
                     detection_mask = np.full(frame_gray.shape, 255, dtype=np.uint8)
-                    for track in active_tracks: cv2.circle(detection_mask, (int(track[-1][0]), int(track[-1][1])), NEW_POINT_MIN_DIST, 0, -1)
+                    for x, y in active_tracks.end_points(): cv2.circle(detection_mask, (int(x), int(y)), NEW_POINT_MIN_DIST, 0, -1)
                     new_points = cv2.goodFeaturesToTrack(old_gray, mask=detection_mask, **feature_params)
-                    if new_points is not None:
-                        for p in new_points: active_tracks.append([tuple(p.ravel())])
+                    active_tracks.add(new_points)
                 
-                # --- 6c. 全軌跡を分析・描画 (変更なし) ---
-                candidate_tracks = [] 
-                for track in active_tracks:
-                    if len(track) < 2: continue
-                    if analyze_trajectory(track):
+                # --- 6c. 全軌跡を分析・描画 ---
+                # 全軌跡をまとめて判定 (点数・下向きの移動量・横ずれの比)
+                is_candidate = classify_trajectories(
+                    active_tracks.start_points(), active_tracks.end_points(), active_tracks.length[:len(active_tracks)],
+                    TRAJECTORY_MIN_DY, TRAJECTORY_DRIFT_RATIO, TRAJECTORY_MIN_POINTS)
+                for i in range(len(active_tracks)):
+                    if active_tracks.length[i] < 2: continue
+                    track = active_tracks.track(i)
+                    if is_candidate[i]:
                         #候補の軌跡が条件を満たしていれば、青い線で描画
-                        candidate_tracks.append(track)
                         cv2.polylines(mask, [np.int32(track)], isClosed=False, color=(255, 100, 0), thickness=2)
                     else:
                         cv2.polylines(mask, [np.int32(track)], isClosed=False, color=(0, 255, 0), thickness=1)
 
                 # --- ★★★ 修正: 6d. 検出メモリ（TTL）の更新 ★★★ ---
                 
-                # (1) このフレームで「熱い」グリッドセルを検出
-                current_hot_cells = find_clusters(
-                    candidate_tracks, 
-                    CLUSTER_GRID_CELL_SIZE, 
-                    RESIZE_WIDTH, 
-                    resize_height, 
-                    CLUSTER_MIN_TRACKS
-                )
-                
-                # (2) メモリ内の既存セルのTTLを 1 減らす
-                expired_cells = []
-                for cell in waterfall_memory:
-                    waterfall_memory[cell] -= 1
-                    if waterfall_memory[cell] <= 0:
-                        expired_cells.append(cell)
-                
-                # (3) TTLが切れた（0になった）セルをメモリから削除
-                for cell in expired_cells:
-                    del waterfall_memory[cell]
-                    
-                # (4) 現在検出された「熱い」セルのTTLを最大値(DETECTION_TTL)でリセット/追加
-                for cell in current_hot_cells:
-                    waterfall_memory[cell] = DETECTION_TTL
+                # (1) メモリ内の全セルのTTLを 1 減らす (0 で「忘れた」ことになる)
+                # (2) 滝候補の軌跡の中間点をセルごとに数え (ヒストグラム)、
+                #     CLUSTER_MIN_TRACKS 本以上集まった「熱い」セルのTTLを最大値(DETECTION_TTL)に戻す
+                waterfall_memory.update(active_tracks.mid_points()[is_candidate], CLUSTER_MIN_TRACKS)
                       
                 # --- ★★★ 修正: 7. 結果の表示 & 標準出力 ★★★ ---
                 
@@ -232,12 +151,12 @@ def main():
                 img = cv2.add(display_frame, mask)
                 
                 # メモリに滝が記憶されている場合のみ描画・出力
-                if waterfall_memory:
+                if waterfall_memory.any_active():
                     # コンソールのクリア（見やすくするため。不要なら削除）
                     print("\033[2J\033[H", end="") 
                     print("--- STABLE WATERFALL DETECTIONS (座標出力) ---")
                     
-                    for (cell_y, cell_x), ttl in waterfall_memory.items():
+                    for cell_y, cell_x, ttl in waterfall_memory.active_cells():
                         # グリッド座標をピクセル座標（円の中心）に変換
                         radius = CLUSTER_GRID_CELL_SIZE // 2
                         center_x = int((cell_x + 0.5) * CLUSTER_GRID_CELL_SIZE)
@@ -254,8 +173,8 @@ def main():
                 cv2.imshow('Original Video', resized_frame)
                 cv2.imshow('Waterfall Trajectory Detection', img)
                 
-                # --- 8. 次のフレームの準備 (変更なし) ---
-                old_gray = frame_gray.copy()
+                # --- 8. 次のフレームの準備 (frame_gray は毎フレーム新しく作られるので、コピーせず参照を引き継ぐ) ---
+                old_gray = frame_gray
                 frame_idx += 1
                 
             # --- 9. キー入力処理 (変更なし) ---
@@ -0,0 +1,625 @@
+#
+# ファイル名: vision_utils.py
+# 役割: 操舵(消失点)検出の共通処理
+#       function1120.py と各操舵スレッドの版 (robot_vision_*.py) から使う
+#
+
+from collections import namedtuple
+
+import cv2
+import math
+
+import numpy as np
+
+# --- RANSAC版の消失点推定パラメータ ---
+RANSAC_ITERATIONS = 64          # 1フレームで試す線ペア数の上限 (計算量を固定する)
+RANSAC_INLIER_DISTANCE = 6.0    # 候補点から線までの距離がこれ以内なら支持線 [px]
+
+# --- ROI (行の帯) 版の操舵パラメータ ---
+ROI_MARGIN_ROWS = 12       # 前回の斜め線の上下に足す余白 [行]
+ROI_MIN_ROWS = 48          # 帯の最小の高さ [行]
+ROI_MAX_FAILURES = 3       # 帯での失敗がこの回数続いたら全画面に戻す
+ROI_MAX_VP_JUMP = 40       # 前回の vp_x からこれ以上ずれた結果は帯での失敗とみなす [px]
+
+# --- 操舵値トラッカー (定速度モデルのカルマンフィルタ) のパラメータ ---
+TRACKER_PROCESS_NOISE = 400.0      # ズレの加速度のばらつき [px^2/s^3]
+TRACKER_MEASUREMENT_NOISE = 4.0    # 信頼度1.0の観測のばらつき [px^2] (信頼度が低いほど大きくする)
+TRACKER_MIN_CONFIDENCE = 0.05      # 信頼度の下限 (0 除算を避ける)
+TRACKER_MAX_PREDICTION_SEC = 0.5   # 最後の観測からこれ以上先は外挿しない [s]
+
+# --- 変化ゲートのパラメータ ---
+CHANGE_GATE_SIZE = (32, 24)        # 比較に使う縮小画像の大きさ (幅, 高さ)
+CHANGE_GATE_THRESHOLD = 2.0        # 平均絶対差 [階調] がこれ未満なら「変化なし」
+CHANGE_GATE_MAX_SKIPS = 10         # 連続で省略してよい回数 (これを超えたら必ず処理する)
+
+# --- 重心 (暗さの重心) エンジンのパラメータ ---
+GRAVITY_DOWNSAMPLE = 4                   # 重心計算用に縦横をこの倍率で縮小する
+GRAVITY_BAND_NAMES = ('far', 'mid', 'near')   # 画面の上から順の横帯
+GRAVITY_BAND_WEIGHTS = (0.2, 0.3, 0.5)   # 帯ごとの重み (近いほど重くする)
+GRAVITY_CONTRAST_FULL_SCALE = 60.0       # 列ごとの暗さの差 [階調] がこれ以上なら信頼度1.0
+
+# --- 深度による通路中心のパラメータ ---
+CORRIDOR_ROWS = (0.3, 0.7)         # 深度画像の縦方向で使う範囲 (高さに対する割合)
+CORRIDOR_STEP = 8                  # 縦横の間引き [px]
+CORRIDOR_MAX_DEPTH = 4.0           # これより遠い値はこの距離として扱う [m]
+CORRIDOR_DEPTH_FULL_SCALE = 1.5    # 列ごとの奥行きの差がこれ以上なら信頼度1.0 [m]
+
+# --- 操舵量の統合 (消失点・重心・通路中心) のパラメータ ---
+FUSION_WEIGHTS = {'vp': 1.0, 'gravity': 0.3, 'corridor': 0.6}   # 信頼度1.0の時の重み
+FUSION_WEIGHT_TIME_CONSTANT = 0.3   # 実効の重みが目標に近づく時定数 [s] (入力の切り替わりを滑らかにする)
+FUSION_OUTPUT_TIME_CONSTANT = 0.1   # 出力の平滑化の時定数 [s]
+
+_rng = np.random.default_rng()
+
+# 重心エンジンの結果 (offset は画像中心からのズレ [px]、帯ごとの値は GRAVITY_BAND_NAMES の順)
+GravityResult = namedtuple('GravityResult', ['offset', 'confidence', 'band_offsets', 'band_confidences'])
+
+
+def remove_small_components(edges, min_area, connectivity=8):
+    """
+    エッジ画像から面積が min_area 以下の連結成分 (ノイズ) を消した画像を返す。
+    成分ごとに画像全体を比較する代わりに、ラベル番号 -> 0/255 の変換表を1回引くだけで済ませる。
+    """
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(edges, connectivity=connectivity)
+    return _component_keep_table(stats, min_area)[labels]
+
+
+def _component_keep_table(stats, min_area):
+    """ラベル番号 -> 0/255 の変換表 (面積が min_area より大きい成分だけ 255)"""
+    lut = np.where(stats[:, cv2.CC_STAT_AREA] > min_area, 255, 0).astype(np.uint8)
+    lut[0] = 0  # ラベル0は背景
+    return lut
+
+
+class SteeringProcessor:
+    """
+    操舵用の前処理 (CLAHE -> ぼかし -> Canny -> 小成分除去) を行うクラス。
+    CLAHE は1回だけ作り、途中の画像は入力サイズで確保したバッファを毎フレーム使い回す
+    (幅が変わるか、確保済みより行数の多い画像が来た時だけ確保し直す。
+    行数の少ない画像 (ROIの帯) はバッファの先頭の行をそのまま使う)。
+    process() の戻り値も内部バッファなので、次の呼び出しまでに使い終えること。
+    """
+    def __init__(self, clip_limit, tile_grid_size, canny_threshold1, canny_threshold2,
+                 min_noise_area, blur_ksize=(7, 7)):
+        self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+        self.canny_threshold1 = canny_threshold1
+        self.canny_threshold2 = canny_threshold2
+        self.min_noise_area = min_noise_area
+        self.blur_ksize = blur_ksize
+        self._capacity = None
+
+    def _allocate(self, shape):
+        self._capacity = shape
+        self._adjusted = np.empty(shape, np.uint8)
+        self._blurred = np.empty(shape, np.uint8)
+        self._edges = np.empty(shape, np.uint8)
+        self._labels = np.empty(shape, np.int32)
+        self._cleaned_edges = np.empty(shape, np.uint8)
+
+    def process(self, gray):
+        """グレースケール画像から、ノイズ除去済みのエッジ画像を返す"""
+        rows, cols = gray.shape[:2]
+        if self._capacity is None or cols != self._capacity[1] or rows > self._capacity[0]:
+            self._allocate((rows, cols))
+
+        # 先頭 rows 行のビュー (C連続のまま)
+        self.adjusted = self._adjusted[:rows]
+        self.blurred = self._blurred[:rows]
+        self.edges = self._edges[:rows]
+        self.labels = self._labels[:rows]
+        self.cleaned_edges = self._cleaned_edges[:rows]
+
+        self.clahe.apply(gray, self.adjusted)
+        cv2.GaussianBlur(self.adjusted, self.blur_ksize, 0, dst=self.blurred)
+        cv2.Canny(self.blurred, self.canny_threshold1, self.canny_threshold2, edges=self.edges)
+
+        _, _, stats, _ = cv2.connectedComponentsWithStats(self.edges, labels=self.labels, connectivity=8)
+        lut = _component_keep_table(stats, self.min_noise_area)
+        np.take(lut, self.labels, out=self.cleaned_edges)
+        return self.cleaned_edges
+
+
+class ChangeGate:
+    """
+    直前に処理したフレームの縮小画像と比べ、変化が小さければ処理を省略してよいと判定するクラス。
+    比較の基準は「最後に処理したフレーム」なので、ゆっくりした変化も積み重なれば処理される。
+    hits (省略) / misses (処理) の回数を数える。
+    """
+    def __init__(self, threshold=CHANGE_GATE_THRESHOLD, size=CHANGE_GATE_SIZE, max_skips=CHANGE_GATE_MAX_SKIPS):
+        self.threshold = threshold
+        self.size = size
+        self.max_skips = max_skips
+        self.hits = 0
+        self.misses = 0
+        self._skips = 0
+        self._thumbnail = np.empty((size[1], size[0]), np.uint8)
+        self._reference = None
+
+    def is_unchanged(self, gray):
+        """True なら前回の結果を使い回してよい。False の場合はこのフレームが次の比較の基準になる"""
+        cv2.resize(gray, self.size, dst=self._thumbnail, interpolation=cv2.INTER_AREA)
+        if self._reference is not None and self._skips < self.max_skips:
+            mean_abs_diff = cv2.norm(self._thumbnail, self._reference, cv2.NORM_L1) / self._thumbnail.size
+            if mean_abs_diff < self.threshold:
+                self._skips += 1
+                self.hits += 1
+                return True
+
+        if self._reference is None:
+            self._reference = np.empty_like(self._thumbnail)
+        np.copyto(self._reference, self._thumbnail)
+        self._skips = 0
+        self.misses += 1
+        return False
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"ヒット {self.hits} / ミス {self.misses} (省略率 {rate:.0%})"
+
+
+class GravityEngine:
+    """
+    重心フォールバック用: 画面の暗い部分の重心 (x座標) を横帯 (遠/中/近) ごとに求めるクラス。
+    縮小画像の積分画像を1回作り、各帯の列ごとの合計をその差分から取り出す。
+    信頼度は列ごとの暗さの差 (最大 - 最小、縮小で平滑化済み) から決める (一様な画面ほど低い)。
+    """
+    def __init__(self, downsample=GRAVITY_DOWNSAMPLE, band_weights=GRAVITY_BAND_WEIGHTS,
+                 contrast_full_scale=GRAVITY_CONTRAST_FULL_SCALE):
+        self.downsample = downsample
+        self.band_weights = np.asarray(band_weights, dtype=np.float64)
+        self.contrast_full_scale = contrast_full_scale
+        self._shape = None
+
+    def _allocate(self, shape):
+        height, width = shape
+        small_width = max(1, width // self.downsample)
+        small_height = max(len(self.band_weights), height // self.downsample)
+        self._shape = shape
+        self._small = np.empty((small_height, small_width), np.uint8)
+        self._integral = np.empty((small_height + 1, small_width + 1), np.int32)
+        self._band_rows = np.linspace(0, small_height, len(self.band_weights) + 1).astype(int)
+        self._band_heights = np.diff(self._band_rows)
+        # 縮小画像の列 j の中心を元画像のx座標にしたもの
+        self._column_x = (np.arange(small_width) + 0.5) * (width / small_width) - 0.5
+
+    def process(self, gray):
+        """グレースケール画像から GravityResult を返す"""
+        if gray.shape[:2] != self._shape:
+            self._allocate(gray.shape[:2])
+        width = self._shape[1]
+        image_center_x = width / 2
+
+        small_height, small_width = self._small.shape
+        cv2.resize(gray, (small_width, small_height), dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.bitwise_not(self._small, dst=self._small)  # 暗いほど大きい値
+        cv2.integral(self._small, self._integral, cv2.CV_32S)
+
+        # 帯の境界の行どうしの差 -> 帯ごとの「列方向の累積和」 -> 列ごとの合計
+        band_cumsum = np.diff(self._integral[self._band_rows], axis=0)
+        column_sums = np.diff(band_cumsum, axis=1)
+        totals = band_cumsum[:, -1]
+
+        centers = np.full(len(totals), image_center_x)
+        has_weight = totals > 0
+        centers[has_weight] = (column_sums[has_weight] @ self._column_x) / totals[has_weight]
+        band_offsets = centers - image_center_x
+
+        column_means = column_sums / self._band_heights[:, None]
+        contrast = column_means.max(axis=1) - column_means.min(axis=1)
+        band_confidences = np.where(has_weight, np.clip(contrast / self.contrast_full_scale, 0.0, 1.0), 0.0)
+
+        # 帯の重み x 信頼度 で合成 (全帯の信頼度が0なら帯の重みだけで合成)
+        weights = self.band_weights * band_confidences
+        if weights.sum() <= 0:
+            weights = self.band_weights
+        offset = float(weights @ band_offsets / weights.sum())
+        confidence = float(self.band_weights @ band_confidences / self.band_weights.sum())
+        return GravityResult(offset, confidence, band_offsets, band_confidences)
+
+
+# ===================================================================
+# 線分検出バックエンド (どれも detect(gray) で HoughLinesP と同じ形 (N, 1, 4) の線分か None を返す)
+# ===================================================================
+class HoughLineBackend:
+    """従来方式: CLAHE -> ぼかし -> Canny -> 小成分除去 (SteeringProcessor) -> HoughLinesP"""
+    name = 'hough'
+
+    def __init__(self, processor, threshold, min_line_length, max_line_gap):
+        self.processor = processor
+        self.threshold = threshold
+        self.min_line_length = min_line_length
+        self.max_line_gap = max_line_gap
+
+    def detect(self, gray):
+        cleaned_edges = self.processor.process(gray)
+        return cv2.HoughLinesP(cleaned_edges, 1, np.pi/180, threshold=self.threshold,
+                               minLineLength=self.min_line_length, maxLineGap=self.max_line_gap)
+
+
+class LsdLineBackend:
+    """LSD (cv2.createLineSegmentDetector)。Canny 等の前処理なしでグレースケールから直接線分を出す"""
+    name = 'lsd'
+
+    def __init__(self, min_line_length):
+        self.min_line_length = min_line_length
+        self.detector = cv2.createLineSegmentDetector(cv2.LSD_REFINE_NONE)
+
+    def detect(self, gray):
+        return _drop_short_lines(self.detector.detect(gray)[0], self.min_line_length)
+
+
+class FastLineBackend:
+    """FastLineDetector (cv2.ximgproc, opencv-contrib が入っている場合のみ)"""
+    name = 'fld'
+
+    def __init__(self, min_line_length, canny_threshold1, canny_threshold2):
+        self.detector = cv2.ximgproc.createFastLineDetector(
+            length_threshold=min_line_length, canny_th1=canny_threshold1,
+            canny_th2=canny_threshold2, do_merge=True)
+
+    def detect(self, gray):
+        lines = self.detector.detect(gray)
+        return None if lines is None or len(lines) == 0 else lines
+
+
+def _drop_short_lines(lines, min_length):
+    """min_length 未満の線分を除く (残らなければ HoughLinesP と同じく None)"""
+    if lines is None or len(lines) == 0:
+        return None
+    x1, y1, x2, y2 = lines.reshape(-1, 4).T
+    lines = lines[np.hypot(x2 - x1, y2 - y1) >= min_length]
+    return lines if len(lines) > 0 else None
+
+
+def available_line_backends():
+    """この環境で使える線分検出バックエンドの名前の一覧"""
+    names = ['hough']
+    try:
+        cv2.createLineSegmentDetector()  # OpenCV 4.1〜4.5.0 では無効化されていて例外になる
+        names.append('lsd')
+    except (AttributeError, cv2.error):
+        pass
+    if hasattr(cv2, 'ximgproc'):
+        names.append('fld')
+    return names
+
+
+def make_line_backend(name, processor, hough_threshold, min_line_length, max_line_gap):
+    """名前から線分検出バックエンドを作る。使えない名前なら警告して 'hough' にする"""
+    if name not in available_line_backends():
+        print(f"[線分検出]: 警告: '{name}' はこの環境で使えません。'hough' を使います。")
+        name = 'hough'
+    if name == 'lsd':
+        return LsdLineBackend(min_line_length)
+    if name == 'fld':
+        return FastLineBackend(min_line_length, processor.canny_threshold1, processor.canny_threshold2)
+    return HoughLineBackend(processor, hough_threshold, min_line_length, max_line_gap)
+
+
+class SteeringRoi:
+    """
+    ROI版の操舵: 前回うまく使えた斜め線のある行の帯 (y0, y1) だけを次のフレームで処理する。
+    - 帯で得た vp_x が見つからない / 前回から ROI_MAX_VP_JUMP 以上ずれた場合は失敗として数える
+    - 失敗が max_failures 回続いたら帯を捨てて全画面に戻す
+    """
+    def __init__(self, margin=ROI_MARGIN_ROWS, min_rows=ROI_MIN_ROWS,
+                 max_failures=ROI_MAX_FAILURES, max_vp_jump=ROI_MAX_VP_JUMP):
+        self.margin = margin
+        self.min_rows = min_rows
+        self.max_failures = max_failures
+        self.max_vp_jump = max_vp_jump
+        self.reset()
+
+    def reset(self):
+        self.rows = None       # None: 全画面を処理
+        self.failures = 0
+        self.last_vp_x = None
+
+    def band(self, height):
+        """次に処理する行の範囲 (y0, y1) を返す"""
+        if self.rows is None:
+            return 0, height
+        return self.rows
+
+    def update(self, lines, vp_x, height):
+        """
+        今回の結果 (lines は全画面の座標) を検証し、次の帯を決める。
+        採用できる vp_x ならそのまま返し、帯での失敗なら None を返す。
+        """
+        if self.rows is not None:
+            if vp_x is None or abs(vp_x - self.last_vp_x) > self.max_vp_jump:
+                self.failures += 1
+                if self.failures >= self.max_failures:
+                    self.reset()
+                return None
+        elif vp_x is None:
+            return None
+
+        self.failures = 0
+        self.last_vp_x = vp_x
+        self.rows = self._rows_from_lines(lines, height)
+        return vp_x
+
+    def _rows_from_lines(self, lines, height):
+        """斜め線が通っている行の範囲に余白を足した帯 (全画面とほぼ同じなら None)"""
+        x1, y1, x2, y2 = np.asarray(lines).reshape(-1, 4).T
+        diagonal = _diagonal_mask(x1, y1, x2, y2)
+        ys = np.concatenate([y1[diagonal], y2[diagonal]])
+        y0 = max(0, int(ys.min()) - self.margin)
+        y1 = min(height, int(ys.max()) + 1 + self.margin)
+
+        # 最小の高さに満たない場合は上下に広げる
+        shortage = self.min_rows - (y1 - y0)
+        if shortage > 0:
+            y0 = max(0, y0 - (shortage + 1) // 2)
+            y1 = min(height, y0 + self.min_rows)
+            y0 = max(0, y1 - self.min_rows)
+        if y1 - y0 >= height:
+            return None
+        return y0, y1
+
+
+def diagonal_segments(lines):
+    """
+    HoughLinesP の線分から斜めの線だけを選び、y = m * x + c の傾き m・切片 c・線分の長さの配列を返す。
+    水平 (|角度| <= 10° または >= 175°)・垂直 (50° <= |角度| <= 130°)・x1 == x2 の線は除く。
+    """
+    if lines is None or len(lines) == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+
+    x1, y1, x2, y2 = np.asarray(lines).reshape(-1, 4).T
+    dx = x2 - x1
+    dy = y2 - y1
+    keep = _diagonal_mask(x1, y1, x2, y2)
+
+    m = dy[keep] / dx[keep]
+    c = y1[keep] - m * x1[keep]
+    length = np.hypot(dx[keep], dy[keep])
+    return m, c, length
+
+
+def _diagonal_mask(x1, y1, x2, y2):
+    """斜めの線 (水平・垂直・x1 == x2 以外) の真偽配列"""
+    dx = x2 - x1
+    abs_angle_deg = np.abs(np.degrees(np.arctan2(y2 - y1, dx)))
+    is_horizontal = (abs_angle_deg <= 10) | (abs_angle_deg >= 175)
+    is_vertical = (abs_angle_deg >= 50) & (abs_angle_deg <= 130)
+    return ~(is_horizontal | is_vertical) & (dx != 0)
+
+
+def diagonal_lines(lines):
+    """斜めの線の傾き m と切片 c の配列を返す (diagonal_segments の長さ無し版)"""
+    m, c, _ = diagonal_segments(lines)
+    return m, c
+
+
+def intersection_x_coords(m, c, width, height):
+    """
+    傾きの符号が逆の線の全ペアについて交点を求め、画面付近
+    (-width < x < 2*width, -height < y < 2*height) にある交点のx座標を返す。
+    """
+    i, j = np.triu_indices(len(m), k=1)
+    m1, m2 = m[i], m[j]
+    c1, c2 = c[i], c[j]
+
+    # 平行に近いペアと、同じ向きに傾いたペアは使わない
+    valid = (np.abs(m1 - m2) >= 1e-5) & ~(m1 * m2 > 0)
+    m1, m2, c1, c2 = m1[valid], m2[valid], c1[valid], c2[valid]
+
+    x = (c2 - c1) / (m1 - m2)
+    y = m1 * x + c1
+    inside = (-width < x) & (x < width * 2) & (-height < y) & (y < height * 2)
+    return x[inside]
+
+
+def estimate_vanishing_point(lines, width, height):
+    """
+    消失点のx座標 (交点のx座標の中央値) を返す。求まらなければ None。
+    元の二重ループ実装と同じ値になる。
+    """
+    m, c = diagonal_lines(lines)
+    if len(m) < 2:
+        return None
+    x_coords = intersection_x_coords(m, c, width, height)
+    if x_coords.size == 0:
+        return None
+    return int(np.median(x_coords))
+
+
+def ransac_vanishing_point(lines, width, height, iterations=RANSAC_ITERATIONS,
+                           inlier_distance=RANSAC_INLIER_DISTANCE, rng=None):
+    """
+    RANSAC版の消失点推定。(vp_x, 信頼度) を返す。求まらなければ (None, 0.0)。
+    - 傾きが右上がり/右下がりの線を1本ずつ選んだペアの交点を候補にする
+      (ペア数が iterations 以下なら全ペア、超える場合は iterations 個だけ無作為に選ぶ)
+    - 各候補の近くを通る線の長さの合計を得票とし、最も得票の多い候補を支持線で最小二乗補正する
+    - 信頼度 = 支持線の長さ / 斜め線全体の長さ (0.0〜1.0)
+    """
+    m, c, length = diagonal_segments(lines)
+    rising = np.flatnonzero(m > 0)
+    falling = np.flatnonzero(m < 0)
+    if rising.size == 0 or falling.size == 0:
+        return None, 0.0
+
+    # --- 1. 候補点 (線ペアの交点) を作る ---
+    num_pairs = rising.size * falling.size
+    if num_pairs <= iterations:
+        i, j = np.meshgrid(rising, falling, indexing='ij')
+        i, j = i.ravel(), j.ravel()
+    else:
+        rng = rng or _rng
+        i = rising[rng.integers(0, rising.size, iterations)]
+        j = falling[rng.integers(0, falling.size, iterations)]
+
+    cand_x = (c[j] - c[i]) / (m[i] - m[j])
+    cand_y = m[i] * cand_x + c[i]
+    inside = (-width < cand_x) & (cand_x < width * 2) & (-height < cand_y) & (cand_y < height * 2)
+    cand_x, cand_y = cand_x[inside], cand_y[inside]
+    if cand_x.size == 0:
+        return None, 0.0
+
+    # --- 2. 長さで重み付けした投票 (候補 × 線 の距離行列) ---
+    norm = np.sqrt(m * m + 1.0)
+    distance = np.abs(np.outer(cand_x, m) - cand_y[:, None] + c) / norm
+    inliers_all = distance <= inlier_distance
+    votes = inliers_all @ length
+    best = int(np.argmax(votes))
+    inliers = inliers_all[best]
+
+    # --- 3. 支持線だけで交点を最小二乗補正 (距離の二乗和を長さで重み付け) ---
+    vp_x = cand_x[best]
+    w = length[inliers] / (norm[inliers] ** 2)
+    a = np.stack([m[inliers], -np.ones(w.size)], axis=1)
+    ata = (a * w[:, None]).T @ a
+    if abs(np.linalg.det(ata)) > 1e-9:
+        refined_x, refined_y = np.linalg.solve(ata, (a * w[:, None]).T @ -c[inliers])
+        if -width < refined_x < width * 2 and -height < refined_y < height * 2:
+            vp_x = refined_x
+
+    confidence = min(1.0, float(votes[best] / length.sum()))
+    return int(vp_x), confidence
+
+
+class SteeringTracker:
+    """
+    操舵値 (消失点のズレ [px]) を定速度モデルのカルマンフィルタで追跡するクラス。
+    画像処理の結果が届くたびに update() で信頼度付きの観測を取り込み、
+    制御ループは predict() で任意の時刻の推定値を得る (画像処理のレートと制御のレートを切り離す)。
+    時刻は元フレームの取得時刻を使うので、画像処理の遅延分も外挿で補われる。
+    """
+    def __init__(self, process_noise=TRACKER_PROCESS_NOISE, measurement_noise=TRACKER_MEASUREMENT_NOISE,
+                 max_prediction=TRACKER_MAX_PREDICTION_SEC):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_prediction = max_prediction
+        self.reset()
+
+    def reset(self):
+        self.state = None       # [ズレ, ズレの速度]
+        self.covariance = None
+        self.time = None        # state の時刻
+
+    def update(self, value, confidence, t):
+        """時刻 t (元フレームの取得時刻) の観測 value を、信頼度 confidence (0.0〜1.0) で取り込む"""
+        r = self.measurement_noise / max(confidence, TRACKER_MIN_CONFIDENCE)
+        if self.state is None:
+            self.state = np.array([value, 0.0])
+            self.covariance = np.diag([r, self.process_noise])
+            self.time = t
+            return
+
+        # --- 予測 (観測が前後した場合は dt = 0 として扱う) ---
+        dt = max(0.0, t - self.time)
+        f = np.array([[1.0, dt], [0.0, 1.0]])
+        q = self.process_noise * np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+        self.state = f @ self.state
+        self.covariance = f @ self.covariance @ f.T + q
+        self.time = max(self.time, t)
+
+        # --- 更新 (観測はズレそのもの) ---
+        innovation = value - self.state[0]
+        gain = self.covariance[:, 0] / (self.covariance[0, 0] + r)
+        self.state = self.state + gain * innovation
+        self.covariance = self.covariance - np.outer(gain, self.covariance[0, :])
+
+    def predict(self, t):
+        """時刻 t のズレの推定値を返す (観測がまだ無ければ None)"""
+        if self.state is None:
+            return None
+        dt = min(max(0.0, t - self.time), self.max_prediction)
+        return float(self.state[0] + self.state[1] * dt)
+
+
+def depth_corridor_offset(depth, depth_scale, output_width, column_map=None, rows=CORRIDOR_ROWS, step=CORRIDOR_STEP):
+    """
+    深度画像から通路の中心 (奥が見えている方向) を求め、(ズレ, 信頼度) を返す。
+    ズレは output_width 幅の操舵用画像の px に換算した値 (右が正)。求まらなければ (None, 0.0)。
+    column_map: 位置合わせ前の深度画像の列 x -> カラー画像の横位置 (-1.0 左端 〜 1.0 右端) の
+                一次式 (scale, offset) (RealSenseSource.depth_column_map)。
+                None なら深度画像はカラー画像に位置合わせ済みとして左右の割合で換算する。
+    中心がカラー画像の外になる場合は画像の端のズレにする。
+    """
+    if depth is None:
+        return None, 0.0
+    height, width = depth.shape[:2]
+    sub = depth[int(height * rows[0]):int(height * rows[1]):step, ::step]
+
+    # 列ごとの有効な (0でない) 深度の平均 [m]
+    valid = sub > 0
+    counts = valid.sum(axis=0)
+    has_depth = counts > 0
+    if np.count_nonzero(has_depth) < 2:
+        return None, 0.0
+    sums = np.minimum(sub * depth_scale, CORRIDOR_MAX_DEPTH).sum(axis=0, where=valid)
+    column_depth = sums[has_depth] / counts[has_depth]
+    column_x = np.flatnonzero(has_depth) * step
+
+    # 一番手前の列より奥に見えている量で重み付けした重心
+    free_depth = column_depth - column_depth.min()
+    total = free_depth.sum()
+    if total <= 0:
+        return None, 0.0
+    center_x = (column_x @ free_depth) / total
+
+    if column_map is None:
+        column_map = (2.0 / width, -1.0)
+    scale, shift = column_map
+    offset = float(np.clip(scale * center_x + shift, -1.0, 1.0)) * (output_width / 2)
+    confidence = min(1.0, (column_depth.max() - column_depth.min()) / CORRIDOR_DEPTH_FULL_SCALE)
+    confidence *= np.count_nonzero(has_depth) / has_depth.size
+    return float(offset), float(confidence)
+
+
+class SteeringFusion:
+    """
+    複数の操舵量 (消失点・重心・深度の通路中心) を1つの操舵量にまとめるクラス。
+    - 各入力は half_width で割って -1.0〜1.0 に正規化し、重み x 信頼度 で加重平均する
+    - 実効の重みは時定数で目標へ近づけ、入力が途切れても最後の値を重みが減るまで使う
+      (消失点 <-> 重心 の切り替わりで操舵量が跳ねないようにする)
+    - 出力も時定数で平滑化し、half_width を掛けて従来の単位 [px] で返す
+    """
+    def __init__(self, half_width, weights=FUSION_WEIGHTS,
+                 weight_time_constant=FUSION_WEIGHT_TIME_CONSTANT,
+                 output_time_constant=FUSION_OUTPUT_TIME_CONSTANT):
+        self.half_width = half_width
+        self.weights = dict(weights)
+        self.weight_time_constant = weight_time_constant
+        self.output_time_constant = output_time_constant
+        self.reset()
+
+    def reset(self):
+        self.effective_weights = {name: 0.0 for name in self.weights}
+        self._last_errors = {}
+        self._error = None   # 正規化した出力
+        self._time = None
+
+    def update(self, sources, t):
+        """
+        sources: {名前: (ズレ[px] または None, 信頼度)}。時刻 t の統合した操舵量 [px] を返す
+        (まだどの入力も無ければ None)。
+        """
+        dt = 0.0 if self._time is None else max(0.0, t - self._time)
+        self._time = t
+        weight_alpha = 1.0 if self._error is None else 1.0 - math.exp(-dt / self.weight_time_constant)
+        output_alpha = 1.0 if self._error is None else 1.0 - math.exp(-dt / self.output_time_constant)
+
+        numerator = 0.0
+        denominator = 0.0
+        for name, base_weight in self.weights.items():
+            value, confidence = sources.get(name, (None, 0.0))
+            target = 0.0
+            if value is not None:
+                self._last_errors[name] = max(-1.0, min(1.0, value / self.half_width))
+                target = base_weight * confidence
+            weight = self.effective_weights[name] + weight_alpha * (target - self.effective_weights[name])
+            self.effective_weights[name] = weight
+            if name in self._last_errors and weight > 0:
+                numerator += weight * self._last_errors[name]
+                denominator += weight
+
+        if denominator <= 1e-6:
+            return None if self._error is None else self._error * self.half_width
+        error = numerator / denominator
+        self._error = error if self._error is None else self._error + output_alpha * (error - self._error)
+        return self._error * self.half_width